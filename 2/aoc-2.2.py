@@ -1,5 +1,147 @@
 #!/usr/bin/env python
 
+import os
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+# Parsed programs, keyed by path, along with the modification time of the file
+# they were read from.
+programImages = {}
+
+# Each parallel search worker process keeps its own pool of machines for the
+# program it was sent when it started.
+workerPool = None
+
+
+class SymbolicError(Exception):
+    """A symbolic value was used somewhere that needs a concrete one."""
+
+    pass
+
+
+class Polynomial:
+    """
+    A polynomial in the noun and verb, for running programs symbolically.
+
+    Terms are kept as {(noun power, verb power): coefficient}. Arithmetic
+    which cancels down to a constant gives a plain int, so anything still a
+    Polynomial really does depend on the noun or verb, and can't be used as an
+    opcode or a destination.
+    """
+
+    def __init__(self, terms):
+        self.terms = {powers: coefficient for powers, coefficient in terms.items() if coefficient != 0}
+
+
+    @staticmethod
+    def simplify(terms):
+        """Make a polynomial, or an int if it turns out to be constant."""
+
+        polynomial = Polynomial(terms)
+
+        if not any(powers != (0, 0) for powers in polynomial.terms):
+            return polynomial.terms.get((0, 0), 0)
+
+        return polynomial
+
+
+    @staticmethod
+    def terms_of(value):
+        if isinstance(value, Polynomial):
+            return value.terms
+
+        return {(0, 0): value}
+
+
+    def __add__(self, other):
+        if other is UNKNOWN:
+            return NotImplemented
+
+        terms = dict(self.terms)
+
+        for powers, coefficient in Polynomial.terms_of(other).items():
+            terms[powers] = terms.get(powers, 0) + coefficient
+
+        return Polynomial.simplify(terms)
+
+    __radd__ = __add__
+
+
+    def __mul__(self, other):
+        if other is UNKNOWN:
+            return NotImplemented
+
+        terms = {}
+
+        for (a, b), x in self.terms.items():
+            for (c, d), y in Polynomial.terms_of(other).items():
+                terms[(a + c, b + d)] = terms.get((a + c, b + d), 0) + x * y
+
+        return Polynomial.simplify(terms)
+
+    __rmul__ = __mul__
+
+
+    def __index__(self):
+        raise SymbolicError("Symbolic value used as an address")
+
+
+    def __eq__(self, other):
+        raise SymbolicError("Symbolic value used as an opcode")
+
+    __ne__ = __eq__
+    __hash__ = None
+
+
+    def evaluate(self, noun, verb):
+        """Substitute values for the noun and verb."""
+
+        return sum(coefficient * noun ** a * verb ** b for (a, b), coefficient in self.terms.items())
+
+
+    def coefficients_in_verb(self, noun):
+        """
+        Substitute a value for the noun, returning the coefficients of the
+        remaining polynomial in the verb, lowest power first.
+        """
+
+        coefficients = [0] * (max(b for a, b in self.terms) + 1)
+
+        for (a, b), coefficient in self.terms.items():
+            coefficients[b] += coefficient * noun ** a
+
+        return coefficients
+
+
+class Unknown:
+    """
+    A value read through a symbolic address, which could have come from
+    anywhere. Anything calculated from it is unknown too.
+    """
+
+    def __add__(self, other):
+        return self
+
+    __radd__ = __add__
+    __mul__ = __add__
+    __rmul__ = __add__
+
+
+    def __index__(self):
+        raise SymbolicError("Unknown value used as an address")
+
+
+    def __eq__(self, other):
+        raise SymbolicError("Unknown value used as an opcode")
+
+    __ne__ = __eq__
+    __hash__ = None
+
+
+NOUN = Polynomial({(1, 0): 1})
+VERB = Polynomial({(0, 1): 1})
+UNKNOWN = Unknown()
+
+
 def readInput(fileName):
     """ Read a single line of comma-separated integers into an array."""
 
@@ -9,6 +151,54 @@ def readInput(fileName):
         return [int(i) for i in firstLine]
 
 
+def readProgramImage(fileName):
+    """
+    Read a program into an immutable tuple, only reading and parsing the file
+    again if it's changed since the last time.
+    """
+
+    path = os.path.abspath(fileName)
+    modified = os.stat(path).st_mtime_ns
+    cached = programImages.get(path)
+
+    if cached is None or cached[0] != modified:
+        cached = (modified, tuple(readInput(path)))
+        programImages[path] = cached
+
+    return cached[1]
+
+
+class MachinePool:
+    """
+    A pool of reusable machine memories for running one program image.
+
+    Released memories are kept and overwritten from the image in place, so a
+    long run of programs doesn't build a new list for each one.
+    """
+
+    def __init__(self, image):
+        self.image = image
+        self.free = []
+
+
+    def acquire(self):
+        """Get a memory holding a fresh copy of the program image."""
+
+        if self.free:
+            program = self.free.pop()
+            program[:] = self.image
+
+            return program
+
+        return list(self.image)
+
+
+    def release(self, program):
+        """Return a memory to the pool once it's finished with."""
+
+        self.free.append(program)
+
+
 def restoreGravityAssistProgram(program):
     program[1] = 12
     program[2] = 2
@@ -16,15 +206,37 @@ def restoreGravityAssistProgram(program):
     return program
 
 
-def runIntcode(program):
-    """Simulate an Intcode machine by processing an array of integers."""
+def readSymbolic(program, address):
+    """Read from memory, where the address might be symbolic."""
+
+    if isinstance(address, int):
+        return program[address]
+
+    return UNKNOWN
+
+
+def runIntcode(program, symbolic = False):
+    """
+    Simulate an Intcode machine by processing an array of integers.
+
+    In symbolic mode memory can also hold Polynomials. Reading through a
+    symbolic address gives UNKNOWN, which is fine as long as it's overwritten
+    before anything needs it. Raises SymbolicError if a symbolic value is
+    needed as an opcode or destination.
+    """
 
     pc = 0
 
     while program[pc] != 99:
         command = program[pc]
-        reg1 = program[program[pc + 1]]
-        reg2 = program[program[pc + 2]]
+
+        if symbolic:
+            reg1 = readSymbolic(program, program[pc + 1])
+            reg2 = readSymbolic(program, program[pc + 2])
+        else:
+            reg1 = program[program[pc + 1]]
+            reg2 = program[program[pc + 2]]
+
         dest = program[pc + 3]
 
         if command == 1:
@@ -77,26 +289,181 @@ def testIntcodeProgram():
     return overallSuccess
 
 
-def bruteForce(target):
+def bruteForce(target, fileName = "aoc-2.1.input"):
+    pool = MachinePool(readProgramImage(fileName))
+
     for noun in range(100):
         for verb in range(100):
-            program = readInput("aoc-2.1.input")
+            program = pool.acquire()
             program[1] = noun
             program[2] = verb
 
-            result = runIntcode(program)
+            result = runIntcode(program)[0]
+            pool.release(program)
 
-            if result[0] == target:
+            if result == target:
                 return (noun, verb)
 
     return None
 
+
+def startSearchWorker(image):
+    """Set up a parallel search worker with the program it'll be running."""
+
+    global workerPool
+    workerPool = MachinePool(image)
+
+
+def searchNoun(noun, target):
+    """Try every verb with one noun, in a parallel search worker."""
+
+    for verb in range(100):
+        program = workerPool.acquire()
+        program[1] = noun
+        program[2] = verb
+
+        result = runIntcode(program)[0]
+        workerPool.release(program)
+
+        if result == target:
+            return verb
+
+    return None
+
+
+def parallelBruteForce(target, fileName = "aoc-2.1.input", workers = None):
+    """
+    Search every noun and verb like bruteForce(), with each noun handed out to
+    a pool of worker processes (one per CPU by default).
+
+    The program is sent to each worker once, when it starts. As soon as a
+    noun turns up a verb, every higher noun is given up on, and only lower
+    ones are waited for. That way the answer is the same one bruteForce()
+    would give. Higher nouns which are already running are left to finish
+    in the background, and the rest are cancelled.
+    """
+
+    image = readProgramImage(fileName)
+    executor = ProcessPoolExecutor(max_workers = workers or os.cpu_count(), initializer = startSearchWorker, initargs = (image,))
+
+    try:
+        searches = {executor.submit(searchNoun, noun, target): noun for noun in range(100)}
+        pending = set(searches)
+        best = None
+
+        while pending:
+            done, pending = wait(pending, return_when = FIRST_COMPLETED)
+
+            for search in done:
+                verb = search.result()
+                noun = searches[search]
+
+                if verb is not None and (best is None or noun < best[0]):
+                    best = (noun, verb)
+
+            if best is not None:
+                pending = {search for search in pending if searches[search] < best[0]}
+    finally:
+        executor.shutdown(wait = False, cancel_futures = True)
+
+    return best
+
+
+def solveSymbolically(target, fileName = "aoc-2.1.input"):
+    """
+    Find the noun and verb which make the program produce the target, by
+    running it once with symbolic noun and verb and solving the result.
+
+    Gives the same answer as bruteForce(), which it falls back to if the
+    result can't be worked out symbolically.
+    """
+
+    program = list(readProgramImage(fileName))
+    program[1] = NOUN
+    program[2] = VERB
+
+    try:
+        result = runIntcode(program, symbolic = True)[0]
+    except SymbolicError:
+        return bruteForce(target, fileName)
+
+    if result is UNKNOWN:
+        return bruteForce(target, fileName)
+
+    if not isinstance(result, Polynomial):
+        return (0, 0) if result == target else None
+
+    for noun in range(100):
+        coefficients = result.coefficients_in_verb(noun)
+
+        if len(coefficients) > 2:
+            verbs = [verb for verb in range(100) if result.evaluate(noun, verb) == target]
+            verb = verbs[0] if verbs else None
+        elif len(coefficients) == 2 and coefficients[1] != 0:
+            verb, remainder = divmod(target - coefficients[0], coefficients[1])
+            verb = verb if remainder == 0 and 0 <= verb < 100 else None
+        else:
+            verb = 0 if coefficients[0] == target else None
+
+        if verb is not None:
+            return (noun, verb)
+
+    return None
+
+
+def testSymbolicSolver():
+    """Check the symbolic solver against concrete runs of the real program."""
+
+    overallSuccess = True
+
+    for noun, verb in [(12, 2), (0, 0), (65, 33), (99, 99)]:
+        program = list(readProgramImage("aoc-2.1.input"))
+        program[1] = noun
+        program[2] = verb
+        target = runIntcode(program)[0]
+
+        solution = solveSymbolically(target)
+
+        if solution == bruteForce(target):
+            print ("Solving for", target, "... ok")
+        else:
+            print ("Solving for", target, "... fail, got", solution)
+            overallSuccess = False
+
+    return overallSuccess
+
+
+def testParallelBruteForce():
+    """Check the parallel search finds the same answers as the serial one."""
+
+    overallSuccess = True
+
+    for target in [19690720, 3790689, 12345]:
+        solution = parallelBruteForce(target)
+
+        if solution == bruteForce(target):
+            print ("Searching in parallel for", target, "... ok")
+        else:
+            print ("Searching in parallel for", target, "... fail, got", solution)
+            overallSuccess = False
+
+    return overallSuccess
+
+
 def main():
     if not testIntcodeProgram():
         print("Tests failed.")
         exit()
 
-    print("noun/verb", bruteForce(19690720))
+    if not testSymbolicSolver():
+        print("Symbolic solver tests failed.")
+        exit()
+
+    if not testParallelBruteForce():
+        print("Parallel search tests failed.")
+        exit()
+
+    print("noun/verb", solveSymbolically(19690720))
 
 
 if __name__ == "__main__":
@@ -2,7 +2,6 @@
 
 import sys
 import ipdb
-from itertools import permutations
 from IPython.core import ultratb
 sys.excepthook = ultratb.FormattedTB(mode='Verbose', color_scheme='Linux', call_pdb=1)
 
@@ -207,19 +206,90 @@ def runAmplifierCombination(program, sequence):
     return signal
 
 
+def searchAmplifierChains(program, phases, signal = 0):
+    """
+    Find the best phase sequence by walking the tree of phase prefixes.
+
+    The signal coming out of the first k amplifiers only depends on their
+    phases, so each prefix is run once and every sequence starting with it
+    carries on from its signal. Returns the best signal, the sequence which
+    gives it, and how many times an amplifier had to be run.
+    """
+
+    if not phases:
+        return signal, (), 0
+
+    best = None
+    runs = 0
+
+    for phase in phases:
+        output = runIntcode(program.copy(), [phase, signal])[0]
+        remaining = [x for x in phases if x != phase]
+
+        result, sequence, count = searchAmplifierChains(program, remaining, output)
+        runs += count + 1
+
+        if best is None or result > best[0]:
+            best = (result, (phase,) + sequence)
+
+    return best[0], best[1], runs
+
+
+def testAmplifierChainSearch():
+    """Make sure the prefix search finds the best sequences from AoC 7.1"""
+
+    tests = [
+            {
+                "program": [3, 15, 3, 16, 1002, 16, 10, 16, 1, 16, 15, 15, 4, 15, 99, 0, 0],
+                "sequence": (4, 3, 2, 1, 0),
+                "output": 43210
+            },
+            {
+                "program": [3, 23, 3, 24, 1002, 24, 10, 24, 1002, 23, -1, 23, 101, 5, 23, 23, 1, 24, 23, 23, 4, 23, 99, 0, 0],
+                "sequence": (0, 1, 2, 3, 4),
+                "output": 54321
+            },
+            {
+                "program": [3, 31, 3, 32, 1002, 32, 10, 32, 1001, 31, -2, 31, 1007, 31, 0, 33, 1002, 33, 7, 33, 1, 33, 31, 31, 1, 32, 31, 31, 4, 31, 99, 0, 0, 0],
+                "sequence": (1, 0, 4, 3, 2),
+                "output": 65210
+            }
+        ]
+
+    overallSuccess = True
+
+    for test in tests:
+        print ("searchAmplifierChains(", test["program"], ") == ", test["output"], sep="")
+
+        result = searchAmplifierChains(test["program"], list(range(5)))
+
+        if result == (test["output"], test["sequence"], 325):
+            print ("Pass")
+        else:
+            print ("Fail: got ", result)
+            overallSuccess = False
+
+        print ("--")
+
+    return overallSuccess
+
+
 def main():
     if not testIntcodeProgram():
         print("Tests failed.")
         exit()
 
+    if not testAmplifierChainSearch():
+        print("Tests failed.")
+        exit()
+
     print ("Tests passed.")
 
     program = readInput("aoc-7.1.input")
-    sequences = list(permutations(range(5)))
-
-    signals = [runAmplifierCombination(program, sequence) for sequence in sequences]
+    signal, sequence, runs = searchAmplifierChains(program, list(range(5)))
 
-    print ("Result: ", max(signals))
+    print ("Sequence", sequence, "after", runs, "runs")
+    print ("Result: ", signal)
 
 
 if __name__ == "__main__":
@@ -1,12 +1,20 @@
 #!/usr/bin/env python
 
+import os
 import sys
 import ipdb
+import asyncio
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from itertools import permutations
 from IPython.core import ultratb
 sys.excepthook = ultratb.FormattedTB(mode='Verbose', color_scheme='Linux', call_pdb=1)
 
 
+# The program loaded by each phase search worker process when it starts.
+worker_program = None
+
+
 class IntcodeInputError(Exception):
     """An error with the input queue for an Intcode machine."""
 
@@ -19,6 +27,14 @@ class IntcodeError(Exception):
     pass
 
 
+# Reasons for run_until() to stop, which are also the events it can be asked
+# to run until.
+HALTED = "halted"
+OUTPUT = "output"
+INPUT = "input"
+BUDGET = "budget"
+
+
 class IntcodeMachine:
     """Intcode machine emulator."""
 
@@ -36,8 +52,8 @@ class IntcodeMachine:
         self.ip = 0
         self.is_running = False
         self.is_waiting = False
-        self.inputs = []
-        self.outputs = []
+        self.inputs = deque()
+        self.outputs = deque()
         self.step_counter = 0
 
 
@@ -71,6 +87,121 @@ class IntcodeMachine:
             self.step()
 
 
+    def run_until(self, event = OUTPUT, budget = None):
+        """
+        Run the program until something happens, and say what it was.
+
+        The event is one of OUTPUT (stop after the next output), INPUT (stop
+        when input is needed) or HALTED (run to the end). Whatever the event,
+        the machine always stops when it halts, when it needs input which
+        isn't there, or when it has run budget instructions. Returns HALTED,
+        OUTPUT, INPUT or BUDGET accordingly.
+
+        Instructions are run in a single loop over local variables rather than
+        through step(), unless the machine is printing or debugging.
+        """
+
+        if not event in (OUTPUT, INPUT, HALTED):
+            raise IntcodeError("Unknown event: {event}".format(event=event))
+
+        stop_on_output = event == OUTPUT
+        limit = sys.maxsize if budget is None else self.step_counter + budget
+
+        self.is_running = True
+
+        if self.verbose or self.debugging:
+            while self.is_running:
+                if self.step_counter >= limit:
+                    return BUDGET
+
+                opcode = self.get_opcode()
+
+                try:
+                    self.step()
+                except IntcodeInputError:
+                    return INPUT
+
+                if opcode == 4 and stop_on_output:
+                    return OUTPUT
+
+            return HALTED
+
+        memory = self.program
+        inputs = self.inputs
+        outputs = self.outputs
+        ip = self.ip
+        steps = self.step_counter
+
+        self.is_waiting = False
+
+        try:
+            while steps < limit:
+                word = memory[ip]
+                opcode = word % 100
+
+                if opcode == 99:
+                    self.is_running = False
+                    steps += 1
+                    return HALTED
+
+                if opcode == 3:
+                    if not inputs:
+                        self.is_waiting = True
+                        return INPUT
+
+                    memory[memory[ip + 1]] = inputs.popleft()
+                    ip += 2
+                    steps += 1
+                    continue
+
+                if not opcode in (1, 2, 4, 5, 6, 7, 8):
+                    raise IntcodeError("Unknown opcode: {opcode}".format(opcode=opcode))
+
+                a = memory[ip + 1]
+
+                if not word // 100 % 10:
+                    a = memory[a]
+
+                if opcode == 4:
+                    outputs.append(a)
+                    ip += 2
+                    steps += 1
+
+                    if stop_on_output:
+                        return OUTPUT
+
+                    continue
+
+                b = memory[ip + 2]
+
+                if not word // 1000 % 10:
+                    b = memory[b]
+
+                if opcode == 5:
+                    ip = b if a != 0 else ip + 3
+                elif opcode == 6:
+                    ip = b if a == 0 else ip + 3
+                else:
+                    if opcode == 1:
+                        value = a + b
+                    elif opcode == 2:
+                        value = a * b
+                    elif opcode == 7:
+                        value = 1 if a < b else 0
+                    else:
+                        value = 1 if a == b else 0
+
+                    memory[memory[ip + 3]] = value
+                    ip += 4
+
+                steps += 1
+
+            return BUDGET
+        finally:
+            self.ip = ip
+            self.step_counter = steps
+
+
     def has_input(self):
         """Determine whether there's an input value waiting to be read."""
 
@@ -89,6 +220,12 @@ class IntcodeMachine:
         self.inputs.append(value)
 
 
+    def add_inputs(self, values):
+        """Add several new input values to the queue, in order."""
+
+        self.inputs.extend(values)
+
+
     def add_output(self, value):
         """Add a new output value to the queue."""
 
@@ -98,7 +235,8 @@ class IntcodeMachine:
     def set_inputs(self, inputs):
         """Populate or overwrite the input queue."""
 
-        self.inputs = inputs
+        self.inputs.clear()
+        self.inputs.extend(inputs)
 
 
     def get_input(self):
@@ -107,16 +245,22 @@ class IntcodeMachine:
         if len(self.inputs) == 0:
             raise IntcodeInputError("No input available")
 
-        value = self.inputs[0]
-        self.inputs = self.inputs[1:]
-
-        return value
+        return self.inputs.popleft()
 
 
     def get_outputs(self):
-        """Get the entire output queue."""
+        """Get the entire output queue, without removing anything from it."""
+
+        return list(self.outputs)
+
 
-        return self.outputs
+    def drain_outputs(self):
+        """Get the entire output queue and empty it."""
+
+        outputs = list(self.outputs)
+        self.outputs.clear()
+
+        return outputs
 
 
     def get_output(self):
@@ -125,10 +269,7 @@ class IntcodeMachine:
         if len(self.outputs) == 0:
             raise IntcodeError("No output is available")
 
-        value = self.outputs[0]
-        self.outputs = self.outputs[1:]
-
-        return value
+        return self.outputs.popleft()
 
 
     def get_opcode(self):
@@ -239,8 +380,8 @@ class IntcodeMachine:
         print ("")
         print ("Machine:", self.name)
         print ("IP:", self.ip)
-        print ("Inputs:", self.inputs)
-        print ("Outputs:", self.outputs)
+        print ("Inputs:", list(self.inputs))
+        print ("Outputs:", list(self.outputs))
         print ("Status:", "running" if self.is_running else "not running", "waiting" if self.is_waiting else "not waiting")
 
         for x in range(len(self.program)):
@@ -429,21 +570,28 @@ class AmplifierGroup:
 
 
     def step(self):
-        """Run a single instruction through whichever amplifier is active."""
+        """
+        Run whichever amplifier is active until it outputs or halts, then
+        pass control to the next one.
+        """
 
         amplifier = self.amplifiers[self.current_index]
+        self.current_index = (self.current_index + 1) % len(self.amplifiers)
+
+        if not amplifier.is_running:
+            return
 
-        while not amplifier.has_output():
-            if amplifier.is_waiting:
-                raise IntcodeError("Amplifier hanging waiting on input.")
+        status = amplifier.run_until(OUTPUT)
 
-            amplifier.step()
+        if status == INPUT:
+            raise IntcodeError("Amplifier hanging waiting on input.")
+
+        if status == HALTED:
+            return
 
         output = amplifier.get_output()
         self.final_result = output
 
-        # Switch to next amplifier.
-        self.current_index = (self.current_index + 1) % len(self.amplifiers)
         next_amplifier = self.amplifiers[self.current_index]
         next_amplifier.add_input(output)
 
@@ -457,6 +605,238 @@ class AmplifierGroup:
         return self.final_result
 
 
+class AsyncAmplifierGroup(AmplifierGroup):
+    """
+    A group of amplifiers connected in series, with each one run as an
+    asyncio task.
+
+    Every amplifier waits on its own queue for input and feeds the next
+    amplifier's queue. An amplifier runs flat out until it needs input it
+    hasn't got, and only then gives the event loop back, so several groups
+    (or anything else) can share one loop.
+    """
+
+    def __init__(self, sequence, program = None, verbose = False, debugging = False):
+        super().__init__(sequence, program = program, verbose = verbose, debugging = debugging)
+
+        self.queues = [asyncio.Queue() for amplifier in self.amplifiers]
+        self.waiting = set()
+
+
+    def is_deadlocked(self):
+        """Check whether every running amplifier is stuck on an empty queue."""
+
+        for index, amplifier in enumerate(self.amplifiers):
+            if amplifier.is_running and (index not in self.waiting or not self.queues[index].empty()):
+                return False
+
+        return True
+
+
+    async def run_amplifier(self, index):
+        """Run one amplifier until it halts, passing its outputs along."""
+
+        amplifier = self.amplifiers[index]
+        inbox = self.queues[index]
+        outbox = self.queues[(index + 1) % len(self.amplifiers)]
+        is_last = index == len(self.amplifiers) - 1
+
+        while True:
+            status = amplifier.run_until(INPUT)
+
+            for output in amplifier.drain_outputs():
+                outbox.put_nowait(output)
+
+                if is_last:
+                    self.final_result = output
+
+            if status == HALTED:
+                # If the rest are all stuck, nobody's left to wake them up.
+                if self.is_deadlocked() and any(amplifier.is_running for amplifier in self.amplifiers):
+                    raise IntcodeError("Amplifiers hanging waiting on input.")
+
+                return
+
+            self.waiting.add(index)
+
+            if self.is_deadlocked():
+                raise IntcodeError("Amplifiers hanging waiting on input.")
+
+            value = await inbox.get()
+            self.waiting.discard(index)
+
+            amplifier.add_input(value)
+
+
+    async def run_async(self):
+        """Run the group on the current event loop and return its signal."""
+
+        tasks = [asyncio.ensure_future(self.run_amplifier(index)) for index in range(len(self.amplifiers))]
+
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        return self.final_result
+
+
+    def run(self):
+        """Run a single permutation through the group of amplifiers."""
+
+        return asyncio.run(self.run_async())
+
+
+class IntcodeNetwork:
+    """
+    Any number of machines, with outputs wired to other machines' inputs.
+
+    Machines which can make progress sit in a ready queue, and each one is
+    run until it halts or blocks on input. A blocked machine is only put
+    back in the queue when something sends it a value, so nothing is ever
+    scanned. If the queue runs dry while machines are still blocked, the
+    network is deadlocked.
+    """
+
+    def __init__(self):
+        self.machines = {}
+        self.wiring = {}
+        self.last_output = {}
+
+
+    def add_machine(self, name, machine, inputs = ()):
+        """Add a machine to the network, with any inputs it starts with."""
+
+        machine.name = name
+        machine.add_inputs(inputs)
+
+        self.machines[name] = machine
+        self.wiring[name] = []
+
+
+    def connect(self, source, destination):
+        """Send everything one machine outputs to another machine's input."""
+
+        self.wiring[source].append(destination)
+
+
+    def run(self):
+        """
+        Run until every machine has halted.
+
+        Raises IntcodeError if the machines which are left are all waiting
+        for input that's never going to come.
+        """
+
+        ready = deque(self.machines)
+        waiting = set()
+
+        while ready:
+            name = ready.popleft()
+
+            machine = self.machines[name]
+            status = machine.run_until(INPUT)
+
+            if status == INPUT:
+                waiting.add(name)
+
+            outputs = machine.drain_outputs()
+
+            if not outputs:
+                continue
+
+            self.last_output[name] = outputs[-1]
+
+            for destination in self.wiring[name]:
+                self.machines[destination].add_inputs(outputs)
+
+                if destination in waiting:
+                    waiting.remove(destination)
+                    ready.append(destination)
+
+        if waiting:
+            raise IntcodeError("Network deadlocked with {count} machines waiting on input.".format(count=len(waiting)))
+
+
+def build_amplifier_network(sequence, program = None):
+    """Wire up a feedback loop of amplifiers, like an AmplifierGroup."""
+
+    network = IntcodeNetwork()
+    names = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+
+    # Long loops are named by number instead.
+    if len(sequence) > len(names):
+        names = range(len(sequence))
+
+    for index, phase in enumerate(sequence):
+        amplifier = IntcodeMachine()
+
+        if program:
+            amplifier.set_program(program)
+        else:
+            amplifier.load_program_from_file("aoc-7.1.input")
+
+        network.add_machine(names[index], amplifier, [phase, 0] if index == 0 else [phase])
+
+    for index in range(len(sequence)):
+        network.connect(names[index], names[(index + 1) % len(sequence)])
+
+    return network
+
+
+def start_search_worker(program, filename):
+    """Load the program once in a phase search worker process."""
+
+    global worker_program
+
+    if program is None:
+        machine = IntcodeMachine()
+        machine.load_program_from_file(filename)
+        program = machine.program
+
+    worker_program = program
+
+
+def run_feedback_loop(sequence):
+    """Run one phase sequence in a search worker and return its signal."""
+
+    network = build_amplifier_network(sequence, worker_program)
+    network.run()
+
+    last_amplifier = list(network.machines)[-1]
+
+    return network.last_output[last_amplifier]
+
+
+def search_phase_sequences(program = None, phases = range(5, 10), count = None, workers = None, filename = "aoc-7.1.input"):
+    """
+    Try every sequence of count different phases (all of them by default) in
+    a feedback loop, spread over a pool of worker processes.
+
+    Returns the sequence with the highest signal, and the signal. Each
+    worker loads the program once, from the file if it isn't given.
+    """
+
+    phases = list(phases)
+    count = count or len(phases)
+    sequences = list(permutations(phases, count))
+    workers = workers or os.cpu_count()
+    chunk_size = max(1, len(sequences) // (workers * 4))
+
+    with ProcessPoolExecutor(max_workers = workers, initializer = start_search_worker, initargs = (program, filename)) as executor:
+        signals = executor.map(run_feedback_loop, sequences, chunksize = chunk_size)
+        best_signal, best_sequence = max(zip(signals, sequences), key = lambda result: result[0])
+
+    return best_sequence, best_signal
+
+
+async def run_groups(groups):
+    """Run several asynchronous amplifier groups at once on one event loop."""
+
+    return await asyncio.gather(*[group.run_async() for group in groups])
+
+
 def testIntcodeMachine():
     """Run sample I/O from AoC questions"""
 
@@ -545,6 +925,25 @@ def testIntcodeMachine():
 
         print ("--")
 
+    # The operand points outside memory, so it mustn't be read first.
+    print ("Testing an unknown opcode")
+
+    machine = IntcodeMachine()
+    machine.set_program([42, 100])
+
+    try:
+        machine.run()
+        print ("Fail: no IntcodeError")
+        overall_success = False
+    except IntcodeError as error:
+        if str(error) == "Unknown opcode: 42":
+            print ("Pass")
+        else:
+            print ("Fail: got IntcodeError", error)
+            overall_success = False
+
+    print ("--")
+
 
     return overall_success
 
@@ -593,6 +992,175 @@ def testAmplifierGroup():
     return overall_success
 
 
+def testAsyncAmplifierGroup():
+    """Run the AoC samples as asynchronous groups, all on one event loop."""
+
+    tests = [
+            {
+                "program": [3, 26, 1001, 26, -4, 26, 3, 27, 1002, 27, 2, 27, 1, 27, 26, 27, 4, 27, 1001, 28, -1, 28, 1005, 28, 6, 99, 0, 0, 5],
+                "sequence": [9, 8, 7, 6, 5],
+                "output": 139629729
+            },
+            {
+                "program": [3, 52, 1001, 52, -5, 52, 3, 53, 1, 52, 56, 54, 1007, 54, 5, 55, 1005, 55, 26, 1001, 54, -5, 54, 1105, 1, 12, 1, 53, 54, 53, 1008, 54, 0, 55, 1001, 55, 1, 55, 2, 53, 55, 53, 4, 53, 1001, 56, -1, 56, 1005, 56, 6, 99, 0, 0, 0, 0, 10],
+                "sequence": [9, 7, 8, 5, 6],
+                "output": 18216
+           }
+        ]
+
+    overall_success = True
+
+    print ("Testing", len(tests), "asynchronous groups together")
+
+    groups = [AsyncAmplifierGroup(program = test["program"], sequence = test["sequence"]) for test in tests]
+    results = asyncio.run(run_groups(groups))
+    expected = [test["output"] for test in tests]
+
+    if results == expected:
+        print ("Pass")
+    else:
+        print ("Fail: got ", results)
+        overall_success = False
+
+    # Every amplifier wants a third input before it outputs anything.
+    print ("Testing a group which hangs")
+
+    group = AsyncAmplifierGroup(program = [3, 11, 3, 11, 3, 11, 4, 11, 99, 0, 0, 0], sequence = [1, 2])
+
+    try:
+        group.run()
+        print ("Fail: no IntcodeError")
+        overall_success = False
+    except IntcodeError:
+        print ("Pass")
+
+    # The second amplifier halts last, leaving the first waiting.
+    print ("Testing a group which hangs after one amplifier halts")
+
+    group = AsyncAmplifierGroup(program = [3, 100, 1005, 100, 10, 3, 101, 3, 101, 99, 104, 5, 3, 101, 99] + [0] * 100, sequence = [0, 1])
+
+    try:
+        group.run()
+        print ("Fail: no IntcodeError")
+        overall_success = False
+    except IntcodeError:
+        print ("Pass")
+
+    print ("--")
+
+    return overall_success
+
+
+def testIntcodeNetwork():
+    """Run amplifier loops and a long chain of machines through a network."""
+
+    overall_success = True
+
+    program = [3, 26, 1001, 26, -4, 26, 3, 27, 1002, 27, 2, 27, 1, 27, 26, 27, 4, 27, 1001, 28, -1, 28, 1005, 28, 6, 99, 0, 0, 5]
+
+    print ("Testing network [9, 8, 7, 6, 5] -> 139629729")
+
+    network = build_amplifier_network([9, 8, 7, 6, 5], program)
+    network.run()
+
+    if network.last_output["E"] == 139629729:
+        print ("Pass")
+    else:
+        print ("Fail: got ", network.last_output["E"])
+        overall_success = False
+
+    # Each machine adds one to its input and passes it on.
+    increment = [3, 9, 1001, 9, 1, 9, 4, 9, 99, 0]
+    count = 500
+
+    print ("Testing a chain of", count, "machines")
+
+    network = IntcodeNetwork()
+
+    for index in range(count):
+        machine = IntcodeMachine()
+        machine.set_program(increment)
+        network.add_machine(index, machine)
+
+        if index > 0:
+            network.connect(index - 1, index)
+
+    network.machines[0].add_input(0)
+    network.run()
+
+    if network.last_output[count - 1] == count:
+        print ("Pass")
+    else:
+        print ("Fail: got ", network.last_output.get(count - 1))
+        overall_success = False
+
+    print ("Testing a network which deadlocks")
+
+    network = IntcodeNetwork()
+
+    for name in "AB":
+        machine = IntcodeMachine()
+        machine.set_program(increment)
+        network.add_machine(name, machine)
+
+    network.connect("A", "B")
+    network.connect("B", "A")
+
+    try:
+        network.run()
+        print ("Fail: no IntcodeError")
+        overall_success = False
+    except IntcodeError:
+        print ("Pass")
+
+    print ("--")
+
+    return overall_success
+
+
+def testPhaseSearch():
+    """Search for the best phases in parallel, including longer loops."""
+
+    program = [3, 26, 1001, 26, -4, 26, 3, 27, 1002, 27, 2, 27, 1, 27, 26, 27, 4, 27, 1001, 28, -1, 28, 1005, 28, 6, 99, 0, 0, 5]
+
+    overall_success = True
+
+    print ("Testing parallel phase search -> 139629729")
+
+    result = search_phase_sequences(program, workers = 2)
+
+    if result == ((9, 8, 7, 6, 5), 139629729):
+        print ("Pass")
+    else:
+        print ("Fail: got ", result)
+        overall_success = False
+
+    # Check a loop of four amplifiers against running each sequence here.
+    print ("Testing parallel phase search over four amplifiers")
+
+    expected = None
+
+    for sequence in permutations(range(5, 10), 4):
+        network = build_amplifier_network(sequence, program)
+        network.run()
+        signal = network.last_output["D"]
+
+        if expected is None or signal > expected[1]:
+            expected = (sequence, signal)
+
+    result = search_phase_sequences(program, count = 4, workers = 2)
+
+    if result == expected:
+        print ("Pass")
+    else:
+        print ("Fail: got ", result, "expected", expected)
+        overall_success = False
+
+    print ("--")
+
+    return overall_success
+
+
 def main():
     if not testIntcodeMachine():
         print("IntcodeMachine tests failed.")
@@ -602,22 +1170,24 @@ def main():
         print("AmplifierGroup tests failed.")
         exit()
 
-    print ("Tests passed.")
+    if not testAsyncAmplifierGroup():
+        print("AsyncAmplifierGroup tests failed.")
+        exit()
 
-    sequences = list(permutations(range(5, 10)))
-    signals = []
+    if not testIntcodeNetwork():
+        print("IntcodeNetwork tests failed.")
+        exit()
 
-    for sequence in sequences:
-        group = AmplifierGroup(sequence, verbose = False, debugging = False)
+    if not testPhaseSearch():
+        print("Phase search tests failed.")
+        exit()
 
-        try:
-            result = group.run()
-        except IntcodeError as error:
-            result = group.final_result
+    print ("Tests passed.")
 
-        signals.append(result)
+    sequence, signal = search_phase_sequences()
 
-    print ("Result: ", max(signals))
+    print ("Sequence", sequence)
+    print ("Result: ", signal)
 
 
 if __name__ == "__main__":
@@ -1,9 +1,23 @@
 #!/usr/bin/env python
 
+import os
 import sys
+import json
+import mmap
 import ipdb
-from itertools import permutations
+import struct
+import tempfile
+import zlib
+from collections import Counter, deque
+from array import array
+from itertools import permutations, product
 from IPython.core import ultratb
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 sys.excepthook = ultratb.FormattedTB(mode='Verbose', color_scheme='Linux', call_pdb=1)
 
 
@@ -19,534 +33,3358 @@ class IntcodeError(Exception):
     pass
 
 
-class IntcodeMachine:
-    """Intcode machine emulator."""
+# Memory is allocated in pages of this many cells. Pages below the dense
+# limit are kept in one flat list for fast access, and pages above it are
+# allocated individually as they're touched.
+PAGE_SIZE = 1024
+DENSE_MEMORY_LIMIT = 64 * PAGE_SIZE
+
+
+# Checkpoint files start with two slots, each holding the magic string, a
+# generation number, the offset, length and CRC-32 of a record, and a CRC-32
+# of the slot itself. The valid slot with the highest generation is current.
+# Its record holds the ip, relative base, step counter, flags (running,
+# waiting), length of the dense program image, and the number of pages,
+# inputs and outputs, followed by a table of page numbers and the offsets of
+# the pages in the file, then the inputs and the outputs. Dense pages are
+# numbered from 0, like sparse ones. Everything is 64-bit integers in native
+# byte order, so that memory can be copied straight out of a mapping of the
+# file.
+#
+# Pages and records are only ever added to the end of the file, and the slot
+# which isn't current is pointed at the new record once everything is on
+# disk, so a crash at any point leaves the last checkpoint intact. When the
+# file grows to CHECKPOINT_COMPACT_RATIO times the size of the pages and
+# queues in use, it's written out again from scratch.
+CHECKPOINT_MAGIC = b"INTCODE2"
+CHECKPOINT_SLOT = struct.Struct("=8s3qII")
+CHECKPOINT_RECORD = struct.Struct("=8q")
+CHECKPOINT_RUNNING = 1
+CHECKPOINT_WAITING = 2
+CHECKPOINT_COMPACT_RATIO = 4
+
+
+# Execution engines which can be selected when running a machine.
+ENGINES = ("step", "threaded", "jit")
 
-    def __init__(self, name = None, verbose = False, debugging = False):
-        self.verbose = verbose
-        self.debugging = debugging
-        self.name = name or "unnamed"
 
-        self.reset()
+# Reasons for run_until() to stop, which are also the events it can be asked
+# to run until.
+HALTED = "halted"
+OUTPUT = "output"
+INPUT = "input"
+BUDGET = "budget"
 
 
-    def reset(self):
-        """Reset the program to the beginning, clearing queues."""
+# How many times an address has to be reached by the JIT engine's
+# interpreter before the block starting there is compiled.
+JIT_THRESHOLD = 8
 
-        self.ip = 0
-        self.is_running = False
-        self.is_waiting = False
-        self.inputs = []
-        self.outputs = []
-        self.step_counter = 0
-        self.relative_base = 0
 
+# Longest run of instructions the JIT engine will compile into one block.
+JIT_MAX_BLOCK_LENGTH = 64
 
-    def set_program(self, program):
-        """Load and initialise a new program."""
 
-        self.program = program.copy()
+# How many times a compiled block can be thrown away because something wrote
+# over its code before the JIT engine stops compiling it.
+JIT_MAX_DEOPTS = 4
 
-        # Allocate buffer space.
-        self.program.extend(0 for x in range(100000))
 
-        self.reset()
+# Threaded code fuses an add, multiply or comparison with the instruction
+# after it, when that's an add or multiply, or a jump which tests the result
+# of the comparison. Fused instructions have this added to the opcode of the
+# first half.
+FUSED = 100
 
 
-    def load_program_from_file(self, filename):
-        """Read a single line of comma-separated integers into an array."""
+# Threaded code marks jumps back to a fixed address, which might close a
+# counted loop, by adding this to their opcode.
+LATCH = 200
 
-        with open(filename) as f:
-            first_line = f.readlines()[0].split(",")
 
-            program = [int(i) for i in first_line]
+# Parameter modes.
+POSITIONAL = 0
+IMMEDIATE = 1
+RELATIVE = 2
 
-        self.set_program(program)
 
+# Number of memory cells (opcode plus parameters) used by each instruction.
+INSTRUCTION_LENGTHS = {
+    1: 4,
+    2: 4,
+    3: 2,
+    4: 2,
+    5: 3,
+    6: 3,
+    7: 4,
+    8: 4,
+    9: 2,
+    99: 1
+}
 
-    def run(self):
-        """Run the program until it exits."""
 
-        if self.is_running:
-            raise IntcodeError("Program is already running")
+# Names of each instruction, for reports.
+OPCODE_NAMES = {
+    1: "add",
+    2: "multiply",
+    3: "input",
+    4: "output",
+    5: "jump if true",
+    6: "jump if false",
+    7: "less than",
+    8: "equals",
+    9: "relative base offset",
+    99: "halt"
+}
 
-        self.is_running = True
 
-        while self.is_running:
-            self.step()
+# Each trace record is the instruction's address, the instruction itself,
+# its three raw operands (zero where it has fewer), the address it wrote to
+# or jumped to (NO_ADDRESS if neither) and the value it produced.
+TRACE_RECORD_SIZE = 7
+NO_ADDRESS = -1
 
 
-    def has_input(self):
-        """Determine whether there's an input value waiting to be read."""
+class IntcodeTrace:
+    """
+    The last few instructions a machine ran, in a fixed-size ring buffer.
 
-        return len(self.inputs) > 0
+    Records are packed into one preallocated array of 64-bit integers and
+    nothing is formatted while the machine runs; format_trace() turns them
+    into text afterwards. If a value is too big for the array, it's swapped
+    for a list.
+    """
 
+    def __init__(self, capacity = 1024):
+        self.capacity = capacity
+        self.records = array("q", [0]) * (capacity * TRACE_RECORD_SIZE)
+        self.position = 0
+        self.count = 0
 
-    def has_output(self):
-        """Determine whether there's an output value waiting to be read."""
 
-        return len(self.outputs) > 0
+    def __len__(self):
+        return min(self.count, self.capacity)
 
 
-    def add_input(self, value):
-        """Add a new input value to the queue."""
+    def __iter__(self):
+        """Go through the records held, oldest first."""
 
-        self.inputs.append(value)
+        start = self.position if self.count >= self.capacity else 0
 
+        for i in range(len(self)):
+            offset = (start + i) % self.capacity * TRACE_RECORD_SIZE
 
-    def add_output(self, value):
-        """Add a new output value to the queue."""
+            yield tuple(self.records[offset:offset + TRACE_RECORD_SIZE])
 
-        self.outputs.append(value)
 
+    def __call__(self, record):
+        """Add a record, overwriting the oldest one if the buffer is full."""
 
-    def set_inputs(self, inputs):
-        """Populate or overwrite the input queue."""
+        offset = self.position * TRACE_RECORD_SIZE
 
-        self.inputs = inputs
+        try:
+            self.records[offset:offset + TRACE_RECORD_SIZE] = array("q", record)
+        except OverflowError:
+            self.records = list(self.records)
+            self.records[offset:offset + TRACE_RECORD_SIZE] = record
 
+        self.position = (self.position + 1) % self.capacity
+        self.count += 1
 
-    def get_input(self):
-        """Get the first waiting input value and remove it from the queue."""
 
-        if len(self.inputs) == 0:
-            raise IntcodeInputError("No input available")
+def format_trace_record(record):
+    """Decode one trace record into a line of text."""
 
-        value = self.inputs[0]
-        self.inputs = self.inputs[1:]
+    ip, word, a, b, c, dest, value = record
+    opcode = word % 100
+    operands = [a, b, c][:INSTRUCTION_LENGTHS[opcode] - 1]
+    line = "{ip:>8}: {word:<6} {name:<20} {operands}".format(ip=ip, word=word, name=OPCODE_NAMES[opcode], operands=operands)
 
-        return value
+    if opcode in (5, 6):
+        line += " -> {dest}".format(dest=dest)
+    elif dest != NO_ADDRESS:
+        line += " -> [{dest}] = {value}".format(dest=dest, value=value)
+    elif opcode in (4, 9):
+        line += " -> {value}".format(value=value)
 
+    return line
 
-    def get_outputs(self):
-        """Get the entire output queue."""
 
-        return self.outputs
+def format_trace(trace):
+    """Decode a trace into one line of text per instruction, oldest first."""
 
+    return [format_trace_record(record) for record in trace]
 
-    def get_output(self):
-        """Get the first waiting output value and remove it from the queue."""
 
-        if len(self.outputs) == 0:
-            raise IntcodeError("No output is available")
+class IntcodeProfile:
+    """
+    Counts of what a machine has executed: each opcode, each address, each
+    combination of opcode and parameter modes, and whether each conditional
+    jump was taken or not.
+    """
+
+    def __init__(self):
+        self.steps = 0
+        self.opcodes = Counter()
+        self.addresses = Counter()
+        self.instructions = Counter()
+        self.jumps = {}
+
 
-        value = self.outputs[0]
-        self.outputs = self.outputs[1:]
+    def __call__(self, record):
+        """
+        Count one instruction from its trace record. A jump to the following
+        instruction counts as not taken.
+        """
 
-        return value
+        ip, word, a, b, c, dest, value = record
+        opcode = word % 100
 
+        self.steps += 1
+        self.opcodes[opcode] += 1
+        self.addresses[ip] += 1
+        self.instructions[word] += 1
 
-    def get_opcode(self):
-        """Get the current opcode, without parameter mode information."""
+        if opcode == 5 or opcode == 6:
+            counts = self.jumps.setdefault(ip, [0, 0])
+            counts[dest == ip + 3] += 1
 
-        return self.program[self.ip] % 100
 
+    def report(self, limit = 10):
+        """Describe the most executed parts of the program, busiest first."""
 
-    def get_parameter_modes(self):
-        """
-        Unpack parameter modes from a single integer.
+        lines = ["Instructions executed: {steps}".format(steps=self.steps), "", "Opcodes:"]
 
-        True: Immediate
-        False: Positional
-        """
+        for opcode, count in self.opcodes.most_common():
+            lines.append("  {name:<22}{count:>12}".format(name=OPCODE_NAMES[opcode], count=count))
 
-        opcode = int(self.program[self.ip] / 100)
-        modes = []
+        lines += ["", "Instructions with modes:"]
 
-        for i in range(3):
-            mode = opcode % 10
+        for word, count in self.instructions.most_common(limit):
+            lines.append("  {word:<22}{count:>12}".format(word=word, count=count))
 
-            if mode == 0:
-                modes.append('positional')
+        lines += ["", "Addresses:"]
 
-            if mode == 1:
-                modes.append('immediate')
+        for address, count in self.addresses.most_common(limit):
+            lines.append("  {address:<22}{count:>12}".format(address=address, count=count))
 
-            if mode == 2:
-                modes.append('relative')
+        lines += ["", "Jumps (taken / not taken):"]
 
-            opcode = int(opcode / 10)
+        for address, (taken, not_taken) in sorted(self.jumps.items(), key = lambda jump: -sum(jump[1]))[:limit]:
+            lines.append("  {address:<22}{taken:>12} / {not_taken}".format(address=address, taken=taken, not_taken=not_taken))
 
-        return modes
+        return "\n".join(lines)
 
 
-    def get_parameters(self, count):
+    def to_json(self):
+        """Dump every count as a JSON string."""
+
+        return json.dumps({
+            "steps": self.steps,
+            "opcodes": {OPCODE_NAMES[opcode]: count for opcode, count in self.opcodes.most_common()},
+            "instructions": {str(word): count for word, count in self.instructions.most_common()},
+            "addresses": {str(address): count for address, count in self.addresses.most_common()},
+            "jumps": {str(address): {"taken": taken, "not taken": not_taken} for address, (taken, not_taken) in sorted(self.jumps.items())}
+        }, indent = 2)
+
+
+class IntcodeSnapshot:
+    """
+    A frozen copy of an Intcode machine's state.
+
+    Memory isn't copied: the snapshot shares it with the machine it came from
+    and with any machines forked from it, each of which copies a page before
+    writing to it.
+    """
+
+    def __init__(self, machine):
+        self.ip = machine.ip
+        self.relative_base = machine.relative_base
+        self.step_counter = machine.step_counter
+        self.is_running = machine.is_running
+        self.is_waiting = machine.is_waiting
+        self.inputs = tuple(machine.inputs)
+        self.outputs = tuple(machine.outputs)
+
+        self.program = machine.program
+        self.pages = dict(machine.pages)
+        self.compact = machine.compact
+
+        self.decode_cache = dict(machine.decode_cache)
+        self.threaded_code = dict(machine.threaded_code)
+        self.block_cache = dict(machine.block_cache)
+        self.block_hits = dict(machine.block_hits)
+        self.block_deopts = dict(machine.block_deopts)
+        self.loop_cache = dict(machine.loop_cache)
+        self.code_cells = {cell: set(starts) for cell, starts in machine.code_cells.items()}
+        self.code_ends = dict(machine.code_ends)
+
+
+class IntcodeMachine:
+    """Intcode machine emulator."""
+
+    def __init__(self, name = None, verbose = False, debugging = False, engine = "step", compact = False):
+        self.verbose = verbose
+        self.debugging = debugging
+        self.name = name or "unnamed"
+        self.engine = engine
+        self.compact = compact
+
+        self.decode_cache = {}
+        self.threaded_code = {}
+        self.block_cache = {}
+        self.block_hits = {}
+        self.block_deopts = {}
+        self.loop_cache = {}
+        self.code_cells = {}
+        self.code_ends = {}
+        self.hooks = []
+        self.profile = None
+        self.trace = None
+
+        self.reset()
+
+
+    def reset(self):
+        """Reset the program to the beginning, clearing queues."""
+
+        self.ip = 0
+        self.is_running = False
+        self.is_waiting = False
+        self.inputs = deque()
+        self.outputs = deque()
+        self.step_counter = 0
+        self.relative_base = 0
+
+
+    def set_program(self, program):
         """
-        Get the parameters for the current opcode, respecting parameter
-        modes.
+        Load and initialise a new program.
+
+        Compact machines keep memory in arrays of 64-bit integers, which take
+        an eighth of the space of a list. If the program doesn't fit, or later
+        computes something which doesn't, the machine switches to lists.
         """
 
-        parameters = []
-        modes = self.get_parameter_modes()
-        address = self.ip + 1
+        self.program = program.copy()
+        self.pages = {}
+        self.program_is_shared = False
+        self.shared_pages = set()
+        self.dirty_pages = set()
+        self.saved_checkpoint = None
+
+        if self.compact:
+            try:
+                self.program = array("q", program)
+            except OverflowError:
+                self.compact = False
+
+        self.decode_cache = {}
+        self.threaded_code = {}
+        self.block_cache = {}
+        self.block_hits = {}
+        self.block_deopts = {}
+        self.loop_cache = {}
+        self.code_cells = {}
+        self.code_ends = {}
 
-        for i in range(count):
-            value = self.program[address]
+        self.reset()
 
-            if modes[i] == 'positional':
-                value = self.program[value]
 
-            if modes[i] == 'relative':
-                value = self.program[self.relative_base + value]
+    def snapshot(self):
+        """
+        Capture the machine's current state.
 
-            parameters.append(value)
-            address += 1
+        From now on the machine shares its memory with the snapshot, and
+        copies each page the first time it writes to it.
+        """
 
-        return parameters
+        self.program_is_shared = True
+        self.shared_pages = set(self.pages)
 
+        return IntcodeSnapshot(self)
 
-    def set_memory_value(self, address, value):
-        """Poke a value into a memory address."""
-        self.program[address] = value
 
+    def load_snapshot(self, snapshot):
+        """Put the machine back into the state captured by a snapshot."""
 
-    def jump(self, address):
-        """Move the instruction pointer to the specified address."""
+        self.ip = snapshot.ip
+        self.relative_base = snapshot.relative_base
+        self.step_counter = snapshot.step_counter
+        self.is_running = snapshot.is_running
+        self.is_waiting = snapshot.is_waiting
+        self.inputs = deque(snapshot.inputs)
+        self.outputs = deque(snapshot.outputs)
 
-        self.ip = address
+        self.program = snapshot.program
+        self.pages = dict(snapshot.pages)
+        self.compact = snapshot.compact
+        self.program_is_shared = True
+        self.shared_pages = set(self.pages)
+        self.dirty_pages = set()
+        self.saved_checkpoint = None
 
+        self.decode_cache = dict(snapshot.decode_cache)
+        self.threaded_code = dict(snapshot.threaded_code)
+        self.block_cache = dict(snapshot.block_cache)
+        self.block_hits = dict(snapshot.block_hits)
+        self.block_deopts = dict(snapshot.block_deopts)
+        self.loop_cache = dict(snapshot.loop_cache)
+        self.code_cells = {cell: set(starts) for cell, starts in snapshot.code_cells.items()}
+        self.code_ends = dict(snapshot.code_ends)
 
-    def jump_rel(self, delta):
-        """Move the instruction pointer by the specified delta."""
 
-        self.ip = self.ip + delta
+    def fork(self, snapshot = None):
+        """
+        Create a new machine which carries on from a snapshot, or from this
+        machine's current state if no snapshot is given.
+        """
 
+        machine = IntcodeMachine(name = self.name, verbose = self.verbose, debugging = self.debugging, engine = self.engine)
+        machine.load_snapshot(snapshot or self.snapshot())
 
-    def halt(self):
-        """Halt execution."""
+        return machine
 
-        if not self.is_running:
-            raise IntcodeError("Program is not running")
 
-        self.is_running = False
+    def checkpoint(self, path):
+        """
+        Save the machine's state to a file it can be restored from.
 
+        If the file holds the last checkpoint this machine saved or was
+        restored from, only the pages which have changed since are added to
+        it, along with a new record of everything else. Otherwise the whole
+        file is written to one side and moved into place. Returns the number
+        of pages written.
 
-    def step(self):
-        """Run the next single instruction."""
+        Sparse pages have changed if they've been written to. The engines
+        write straight into the dense program image, so that's compared with
+        a copy kept from the last checkpoint instead.
 
-        if not self.is_running:
-            raise IntcodeError("Program has halted")
+        Every value has to fit in 64 bits.
+        """
 
-        instruction_set = {
-            1: self.add,
-            2: self.multiply,
-            3: self.input,
-            4: self.output,
-            5: self.jump_if_true,
-            6: self.jump_if_false,
-            7: self.set_if_less_than,
-            8: self.set_if_equal,
-            9: self.relative_base_offset,
-            99: self.halt
-        }
+        saved = self.saved_checkpoint
+        dense_count = (len(self.program) + PAGE_SIZE - 1) // PAGE_SIZE
+        page_bytes = PAGE_SIZE * 8
 
-        opcode = self.get_opcode()
+        if saved is not None:
+            in_use = (dense_count + len(self.pages)) * page_bytes + (len(self.inputs) + len(self.outputs)) * 8
 
-        if not opcode in instruction_set:
-            raise IntcodeError("Unknown opcode: {opcode}".format(opcode=opcode))
+            if not checkpoint_is_current(path, saved) or saved["size"] > CHECKPOINT_COMPACT_RATIO * in_use:
+                saved = None
 
-        if self.debugging:
-            self.debug()
+        if saved is None:
+            changed = list(range(dense_count)) + sorted(self.pages)
+        else:
+            old = saved["program"]
+            changed = [number for number in range(dense_count) if not number in saved["offsets"] or self.program[number * PAGE_SIZE:(number + 1) * PAGE_SIZE] != old[number * PAGE_SIZE:(number + 1) * PAGE_SIZE]]
+            changed += sorted(number for number in self.pages if number in self.dirty_pages or not number in saved["offsets"])
 
-        self.is_waiting = False
+        try:
+            pages = []
+
+            for number in changed:
+                page = array("q", self.pages[number] if number >= dense_count else self.program[number * PAGE_SIZE:(number + 1) * PAGE_SIZE])
+                page.extend([0] * (PAGE_SIZE - len(page)))
+                pages.append(page.tobytes())
+
+            queues = array("q", list(self.inputs) + list(self.outputs))
+        except OverflowError:
+            raise IntcodeError("Memory or queues hold values too big for a checkpoint")
+
+        if saved is None:
+            generation = 1
+            offsets = {}
+            f = open(path + ".tmp", "w+b")
+            f.write(bytes(2 * CHECKPOINT_SLOT.size))
+        else:
+            generation = saved["generation"] + 1
+            offsets = dict(saved["offsets"])
+            f = open(path, "r+b")
+
+            # Anything past the end of the last checkpoint was left by one
+            # which didn't finish, so it's written over.
+            f.seek(saved["size"])
+
+        with f:
+            for number, page in zip(changed, pages):
+                offsets[number] = f.tell()
+                f.write(page)
+
+            flags = (CHECKPOINT_RUNNING if self.is_running else 0) | (CHECKPOINT_WAITING if self.is_waiting else 0)
+            table = array("q", [value for number in sorted(offsets) for value in (number, offsets[number])])
+            record = CHECKPOINT_RECORD.pack(self.ip, self.relative_base, self.step_counter, flags, len(self.program), len(offsets), len(self.inputs), len(self.outputs))
+            record += table.tobytes() + queues.tobytes()
+            record_offset = f.tell()
+
+            f.write(record)
+            f.truncate()
+            f.flush()
+            os.fsync(f.fileno())
+
+            # Only now that everything it points to is on disk is the new
+            # record made current.
+            slot = CHECKPOINT_SLOT.pack(CHECKPOINT_MAGIC, generation, record_offset, len(record), zlib.crc32(record), 0)
+            slot = slot[:-4] + struct.pack("=I", zlib.crc32(slot[:-4]))
+
+            f.seek(generation % 2 * CHECKPOINT_SLOT.size)
+            f.write(slot)
+            f.flush()
+            os.fsync(f.fileno())
+
+        if saved is None:
+            os.replace(path + ".tmp", path)
+
+        self.saved_checkpoint = {
+            "file": checkpoint_file_id(path),
+            "generation": generation,
+            "size": record_offset + len(record),
+            "offsets": offsets,
+            "program": self.program[:]
+        }
 
-        instruction_set[opcode]()
-        self.step_counter += 1
+        self.dirty_pages = set()
 
+        return len(pages)
 
-    def debug(self):
-        print ("")
-        print ("Machine:", self.name)
-        print ("IP:", self.ip)
-        print ("Relative base:", self.relative_base)
-        print ("Inputs:", self.inputs)
-        print ("Outputs:", self.outputs)
-        print ("Status:", "running" if self.is_running else "not running", "waiting" if self.is_waiting else "not waiting")
 
-        for x in range(len(self.program)):
-            print ("* " if x == self.ip else "  ", x, "] ", self.program[x], sep = "")
+    @classmethod
+    def restore(cls, path, name = None, engine = "step"):
+        """
+        Create a machine from a checkpoint file.
 
-            if x > 18:
-                break
+        Memory is copied straight out of a mapping of the file into compact
+        memory, which switches to lists as usual if it later needs to.
+        """
 
-        input ("Press enter to continue")
+        with open(path, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as mapped:
+                slot = read_checkpoint_slot(mapped)
+
+                if slot is None:
+                    raise IntcodeError("Not an Intcode checkpoint: {path}".format(path=path))
+
+                generation, record_offset, record_length = slot
+                ip, relative_base, step_counter, flags, dense_length, page_count, input_count, output_count = CHECKPOINT_RECORD.unpack_from(mapped, record_offset)
+
+                def read(offset, count):
+                    values = array("q")
+                    values.frombytes(mapped[offset:offset + count * values.itemsize])
+
+                    return values, offset + count * values.itemsize
+
+                table, offset = read(record_offset + CHECKPOINT_RECORD.size, page_count * 2)
+                inputs, offset = read(offset, input_count)
+                outputs, offset = read(offset, output_count)
+
+                offsets = dict(zip(table[::2], table[1::2]))
+                program = array("q")
+                pages = {}
+
+                for number, page_offset in offsets.items():
+                    if number * PAGE_SIZE < dense_length:
+                        program.extend(read(page_offset, PAGE_SIZE)[0])
+                    else:
+                        pages[number] = read(page_offset, PAGE_SIZE)[0]
+
+                del program[dense_length:]
+
+        machine = cls(name = name, engine = engine, compact = True)
+        machine.set_program([])
+
+        machine.program = program
+        machine.pages = pages
+        machine.ip = ip
+        machine.relative_base = relative_base
+        machine.step_counter = step_counter
+        machine.is_running = bool(flags & CHECKPOINT_RUNNING)
+        machine.is_waiting = bool(flags & CHECKPOINT_WAITING)
+        machine.inputs.extend(inputs)
+        machine.outputs.extend(outputs)
+
+        machine.saved_checkpoint = {
+            "file": checkpoint_file_id(path),
+            "generation": generation,
+            "size": record_offset + record_length,
+            "offsets": offsets,
+            "program": program[:]
+        }
 
+        return machine
 
-    def add(self):
-        """Add."""
 
-        parameters = self.get_parameters(2)
-        dest = self.program[self.ip + 3]
+    def load_program_from_file(self, filename):
+        """Read a single line of comma-separated integers into an array."""
 
-        modes = self.get_parameter_modes()
+        with open(filename) as f:
+            first_line = f.readlines()[0].split(",")
 
-        if modes[2] == 'relative':
-            dest += self.relative_base
+            program = [int(i) for i in first_line]
 
-        value = parameters[0] + parameters[1]
+        self.set_program(program)
 
-        if self.verbose:
-            print (self.name, self.ip, "(add)", parameters, ":", [dest], "=", value)
 
-        self.set_memory_value(dest, value)
-        self.jump_rel(4)
+    def run(self, engine = None):
+        """
+        Run the program until it exits.
 
+        The engine defaults to the one the machine was created with. Raises
+        IntcodeInputError if the program needs input which isn't there.
+        """
 
-    def multiply(self):
-        """Multiply."""
+        if self.is_running:
+            raise IntcodeError("Program is already running")
 
-        parameters = self.get_parameters(2)
-        dest = self.program[self.ip + 3]
+        if self.run_until(HALTED, engine = engine) == INPUT:
+            raise IntcodeInputError("No input available")
 
-        modes = self.get_parameter_modes()
 
-        if modes[2] == 'relative':
-            dest += self.relative_base
+    def run_until(self, event = OUTPUT, budget = None, engine = None):
+        """
+        Run the program until something happens, and say what it was.
 
-        value = parameters[0] * parameters[1]
+        The event is one of OUTPUT (stop after the next output), INPUT (stop
+        when input is needed) or HALTED (run to the end). Whatever the event,
+        the machine always stops when it halts, when it needs input which
+        isn't there, or when it has run budget instructions. Returns HALTED,
+        OUTPUT, INPUT or BUDGET accordingly.
 
-        if self.verbose:
-            print (self.name, self.ip, "(multiply)", parameters, ":", [dest], "=", value)
+        None of the engines print, debug or call hooks, so that they don't
+        have to check for them on every instruction. When any of those are
+        wanted, a separate hooked engine is used instead.
+        """
 
-        self.set_memory_value(dest, value)
-        self.jump_rel(4)
+        engine = engine or self.engine
 
+        if not engine in ENGINES:
+            raise IntcodeError("Unknown engine: {engine}".format(engine=engine))
 
-    def input(self):
-        """Input."""
+        if not event in (OUTPUT, INPUT, HALTED):
+            raise IntcodeError("Unknown event: {event}".format(event=event))
 
-        if not self.has_input():
-            self.is_waiting = True
+        stop_on_output = event == OUTPUT
+        limit = sys.maxsize if budget is None else self.step_counter + budget
 
-            raise IntcodeInputError("No input available")
+        self.is_running = True
 
-        dest = self.program[self.ip + 1]
-        modes = self.get_parameter_modes()
+        # The faster engines write straight into the program image, so it
+        # can't be shared with a snapshot while they run.
+        if self.program_is_shared:
+            self.unshare_program()
 
-        if modes[0] == 'relative':
-            dest += self.relative_base
+        if self.hooks or self.verbose or self.debugging:
+            return self.run_hooked(stop_on_output, limit)
 
-        value = self.get_input()
+        if engine == "threaded":
+            return self.run_threaded(stop_on_output, limit)
 
-        if self.verbose:
-            print (self.name, self.ip, "(input)", [dest], "=", value)
+        if engine == "jit":
+            return self.run_jit(stop_on_output, limit)
 
-        self.set_memory_value(dest, value)
-        self.jump_rel(2)
+        return self.run_stepping(stop_on_output, limit)
 
 
-    def output(self):
-        """Output."""
+    def execute(self, engine = None):
+        """
+        Run the program as a generator which yields each output as it's made.
+
+        When the program needs input which isn't queued, the generator yields
+        None and waits for a value to be passed in with send(), or for one to
+        be queued with add_input() before it's resumed with next(). A value
+        sent in after an output is queued as input too, so machines can be
+        chained by sending each one's outputs into the next. The generator
+        finishes when the program halts.
+        """
 
-        parameters = self.get_parameters(1)
-        value = parameters[0]
+        while True:
+            status = self.run_until(OUTPUT, engine = engine)
 
-        if self.verbose:
-            print (self.name, self.ip, "(output) ", value)
+            if status == HALTED:
+                return
 
-        self.add_output(value)
-        self.jump_rel(2)
+            if status == OUTPUT:
+                value = yield self.outputs.popleft()
+            else:
+                value = yield None
 
+                if value is None and not self.inputs:
+                    raise IntcodeInputError("No input was sent to a waiting machine")
 
-    def jump_if_true(self):
-        """Jump if true."""
+            if value is not None:
+                self.inputs.append(value)
 
-        parameters = self.get_parameters(2)
-        value = parameters[0]
-        dest = parameters[1]
 
-        if self.verbose:
-            print (self.name, self.ip, "(jump if true)", parameters)
+    def run_stepping(self, stop_on_output, limit):
+        """
+        Run the program one instruction at a time until it stops.
 
-        if value != 0:
-            self.jump(dest)
-        else:
-            self.jump_rel(3)
+        This does what step() does, without the check for debugging, which
+        only the hooked engine and outside callers of step() need.
+        """
 
+        while self.is_running:
+            if self.step_counter >= limit:
+                return BUDGET
 
-    def jump_if_false(self):
-        """Jump if false."""
+            opcode, modes, handler = self.decode()
 
-        parameters = self.get_parameters(2)
-        value = parameters[0]
-        dest = parameters[1]
+            self.is_waiting = False
 
-        if self.verbose:
-            print (self.name, self.ip, "(jump if false)", parameters)
+            try:
+                handler(self)
+            except IntcodeInputError:
+                return INPUT
 
-        if value == 0:
-            self.jump(dest)
-        else:
-            self.jump_rel(3)
+            self.step_counter += 1
 
+            if opcode == 4 and stop_on_output:
+                return OUTPUT
 
-    def set_if_less_than(self):
-        """Set if less than."""
+        return HALTED
 
-        parameters = self.get_parameters(2)
-        dest = self.program[self.ip + 3]
 
-        modes = self.get_parameter_modes()
+    def run_hooked(self, stop_on_output, limit):
+        """
+        Run the program one step() at a time, like run_stepping(), with
+        everything switched on which the other engines leave out.
 
-        if modes[2] == 'relative':
-            dest += self.relative_base
+        Before each instruction, step() drops into debug() if the machine is
+        debugging. After it, a trace record of the instruction is printed if
+        the machine is verbose, and passed to every hook.
+        """
 
-        value = 1 if parameters[0] < parameters[1] else 0
+        hooks = list(self.hooks)
 
-        if self.verbose:
-            print (self.name, self.ip, "(set if less than) ", parameters, ": ", [dest], "=", value)
+        while self.is_running:
+            if self.step_counter >= limit:
+                return BUDGET
 
-        self.set_memory_value(dest, value)
-        self.jump_rel(4)
+            ip = self.ip
+            opcode, modes, handler = self.decode()
+            word = self.get_memory_value(ip)
+            length = INSTRUCTION_LENGTHS[opcode]
+            operands = [self.get_memory_value(ip + i) if i < length else 0 for i in (1, 2, 3)]
+            dest = NO_ADDRESS
 
+            # Input writes with its first operand, and the arithmetic and
+            # comparison instructions with their third.
+            if opcode in (1, 2, 3, 7, 8):
+                dest = operands[length - 2]
 
-    def set_if_equal(self):
-        """Set if equal."""
+                if modes[length - 2] == RELATIVE:
+                    dest += self.relative_base
 
-        parameters = self.get_parameters(2)
-        dest = self.program[self.ip + 3]
+            try:
+                self.step()
+            except IntcodeInputError:
+                return INPUT
 
-        modes = self.get_parameter_modes()
+            value = 0
 
-        if modes[2] == 'relative':
-            dest += self.relative_base
+            if dest != NO_ADDRESS:
+                value = self.get_memory_value(dest)
+            elif opcode == 4:
+                value = self.outputs[-1]
+            elif opcode == 9:
+                value = self.relative_base
+            elif opcode in (5, 6):
+                dest = self.ip
 
-        value = 1 if parameters[0] == parameters[1] else 0
+            record = (ip, word, operands[0], operands[1], operands[2], dest, value)
 
-        if self.verbose:
-            print (self.name, self.ip, "(set if equal) ", parameters, ": ", [dest], "=", value)
+            if self.verbose:
+                print (self.name, format_trace_record(record))
 
-        self.set_memory_value(dest, value)
-        self.jump_rel(4)
+            for hook in hooks:
+                hook(record)
 
+            if opcode == 4 and stop_on_output:
+                return OUTPUT
 
-    def relative_base_offset(self):
-        """Adjust relative base."""
-        parameters = self.get_parameters(1)
-        offset = parameters[0]
+        return HALTED
 
-        self.relative_base += offset
-        self.jump_rel(2)
 
+    def add_hook(self, hook):
+        """
+        Call something with the trace record of every instruction run from
+        now on. Any callable taking one argument will do.
+        """
 
-    def halt(self):
-        if self.verbose:
-            print (self.name, self.ip, "(halt)")
+        self.hooks.append(hook)
 
-        self.is_running = False
 
+    def remove_hook(self, hook):
+        """
+        Stop calling a hook. The machine goes back to its own engine once none
+        are left.
+        """
 
-def testIntcodeMachine():
-    """Run sample I/O from AoC questions"""
+        self.hooks.remove(hook)
 
-    tests = [
+
+    def enable_profiling(self):
+        """Start counting what the machine executes, and return the profile."""
+
+        if self.profile is not None:
+            self.remove_hook(self.profile)
+
+        self.profile = IntcodeProfile()
+        self.add_hook(self.profile)
+
+        return self.profile
+
+
+    def disable_profiling(self):
+        """Stop profiling, and return the profile collected so far."""
+
+        profile = self.profile
+        self.profile = None
+
+        if profile is not None:
+            self.remove_hook(profile)
+
+        return profile
+
+
+    def enable_tracing(self, capacity = 1024):
+        """Start recording the last capacity instructions, and return them."""
+
+        if self.trace is not None:
+            self.remove_hook(self.trace)
+
+        self.trace = IntcodeTrace(capacity)
+        self.add_hook(self.trace)
+
+        return self.trace
+
+
+    def disable_tracing(self):
+        """Stop tracing, and return the trace recorded so far."""
+
+        trace = self.trace
+        self.trace = None
+
+        if trace is not None:
+            self.remove_hook(trace)
+
+        return trace
+
+
+    def run_threaded(self, stop_on_output, limit):
+        """
+        Run the program with everything held in local variables.
+
+        Instructions are pre-decoded into the threaded code table so each one
+        is a single lookup followed by an inline operation, and common pairs
+        of instructions are fused so that they share one lookup. Counted
+        loops are skipped over with fast_forward() when they jump back.
+
+        State is only written back to the machine when it stops, or when an
+        instruction touches memory which hasn't been allocated yet, overflows
+        compact memory or uses a negative address, and has to be handed to
+        step(). (Lists would quietly wrap negative addresses around.)
+        """
+
+        memory = self.program
+        code = self.threaded_code
+        code_cells = self.code_cells
+        loops = self.loop_cache
+        inputs = self.inputs
+        outputs = self.outputs
+
+        ip = self.ip
+        relative_base = self.relative_base
+        steps = self.step_counter
+
+        self.is_waiting = False
+
+        try:
+            while True:
+                try:
+                    while steps < limit:
+                        instruction = code.get(ip)
+
+                        if instruction is None:
+                            instruction = self.decode_threaded(ip)
+
+                        opcode, mode_a, mode_b, mode_c, a, b, c, second = instruction
+
+                        if opcode > FUSED:
+                            if opcode < LATCH:
+                                if mode_a == POSITIONAL:
+                                    a = memory[a]
+                                elif mode_a == RELATIVE:
+                                    a += relative_base
+
+                                    if a < 0:
+                                        raise IndexError(a)
+
+                                    a = memory[a]
+
+                                if mode_b == POSITIONAL:
+                                    b = memory[b]
+                                elif mode_b == RELATIVE:
+                                    b += relative_base
+
+                                    if b < 0:
+                                        raise IndexError(b)
+
+                                    b = memory[b]
+
+                                if opcode == FUSED + 1:
+                                    value = a + b
+                                elif opcode == FUSED + 2:
+                                    value = a * b
+                                elif opcode == FUSED + 7:
+                                    value = 1 if a < b else 0
+                                else:
+                                    value = 1 if a == b else 0
+
+                                dest = c + relative_base if mode_c == RELATIVE else c
+
+                                if dest < 0:
+                                    raise IndexError(dest)
+
+                                memory[dest] = value
+
+                                # The first half is done, so anything going
+                                # wrong from here on is handed to step() from
+                                # the second.
+                                ip += 4
+                                steps += 1
+
+                                if dest in code_cells:
+                                    self.invalidate(dest)
+                                    continue
+
+                                if steps >= limit:
+                                    continue
+
+                                opcode, mode_a, mode_b, mode_c, a, b, c, second = second
+
+                            if opcode > LATCH:
+                                if mode_a == POSITIONAL:
+                                    a = memory[a]
+                                elif mode_a == RELATIVE:
+                                    a += relative_base
+
+                                    if a < 0:
+                                        raise IndexError(a)
+
+                                    a = memory[a]
+
+                                if (a == 0) == (opcode == LATCH + 5):
+                                    ip += 3
+                                else:
+                                    if loops.get(b) is not False:
+                                        steps = self.fast_forward(b, ip, relative_base, steps, limit)
+                                        memory = self.program
+
+                                    ip = b
+
+                                steps += 1
+                                continue
+
+                        if opcode == 99:
+                            self.is_running = False
+                            steps += 1
+                            return HALTED
+
+                        if opcode == 3:
+                            if not inputs:
+                                self.is_waiting = True
+                                return INPUT
+
+                            dest = a + relative_base if mode_a == RELATIVE else a
+
+                            if dest < 0:
+                                raise IndexError(dest)
+
+                            memory[dest] = inputs[0]
+                            inputs.popleft()
+
+                            if dest in code_cells:
+                                self.invalidate(dest)
+
+                            ip += 2
+                            steps += 1
+                            continue
+
+                        if mode_a == POSITIONAL:
+                            a = memory[a]
+                        elif mode_a == RELATIVE:
+                            a += relative_base
+
+                            if a < 0:
+                                raise IndexError(a)
+
+                            a = memory[a]
+
+                        if opcode == 4:
+                            outputs.append(a)
+                            ip += 2
+
+                            if stop_on_output:
+                                steps += 1
+                                return OUTPUT
+                        elif opcode == 9:
+                            relative_base += a
+                            ip += 2
+                        else:
+                            if mode_b == POSITIONAL:
+                                b = memory[b]
+                            elif mode_b == RELATIVE:
+                                b += relative_base
+
+                                if b < 0:
+                                    raise IndexError(b)
+
+                                b = memory[b]
+
+                            if opcode == 5:
+                                ip = b if a != 0 else ip + 3
+                            elif opcode == 6:
+                                ip = b if a == 0 else ip + 3
+                            else:
+                                if opcode == 1:
+                                    value = a + b
+                                elif opcode == 2:
+                                    value = a * b
+                                elif opcode == 7:
+                                    value = 1 if a < b else 0
+                                else:
+                                    value = 1 if a == b else 0
+
+                                dest = c + relative_base if mode_c == RELATIVE else c
+
+                                if dest < 0:
+                                    raise IndexError(dest)
+
+                                memory[dest] = value
+
+                                if dest in code_cells:
+                                    self.invalidate(dest)
+
+                                ip += 4
+
+                        steps += 1
+
+                    return BUDGET
+                except (IndexError, OverflowError):
+                    self.ip = ip
+                    self.relative_base = relative_base
+                    self.step_counter = steps
+
+                    status = self.fall_back(stop_on_output)
+
+                    memory = self.program
+                    ip = self.ip
+                    relative_base = self.relative_base
+                    steps = self.step_counter
+
+                    if status is not None:
+                        return status
+        finally:
+            self.ip = ip
+            self.relative_base = relative_base
+            self.step_counter = steps
+
+
+    def run_jit(self, stop_on_output, limit):
+        """
+        Run the program, compiling hot basic blocks into Python functions.
+
+        Addresses are interpreted one instruction at a time with step() until
+        they've been reached JIT_THRESHOLD times, at which point the block
+        starting there is compiled and used from then on. A block which writes
+        into any decoded code hands control back here so the stale code can be
+        thrown away, and one which touches unallocated memory or overflows
+        compact memory hands back the instruction which did it to step().
+        Near the end of a budget the remaining instructions are stepped, so a
+        block can't overrun it.
+
+        A block which keeps being thrown away is only compiled JIT_MAX_DEOPTS
+        times, and is interpreted from then on.
+        """
+
+        memory = self.program
+        blocks = self.block_cache
+        hits = self.block_hits
+        deopts = self.block_deopts
+        code_cells = self.code_cells
+        inputs = self.inputs
+        outputs = self.outputs
+
+        ip = self.ip
+        relative_base = self.relative_base
+        steps = self.step_counter
+
+        self.is_waiting = False
+
+        try:
+            while steps < limit:
+                block = blocks.get(ip)
+
+                if block is None or limit - steps < JIT_MAX_BLOCK_LENGTH:
+                    count = hits.get(ip, 0) + 1
+                    hits[ip] = count
+
+                    if block is None and count >= JIT_THRESHOLD and limit - steps >= JIT_MAX_BLOCK_LENGTH and deopts.get(ip, 0) < JIT_MAX_DEOPTS:
+                        block = self.compile_block(ip)
+                    else:
+                        block = None
+
+                if block is None:
+                    status = "step"
+                else:
+                    ip, relative_base, count, status = block(memory, relative_base, code_cells, inputs, outputs.append)
+                    steps += count
+
+                    if status is None:
+                        continue
+
+                if status == "step":
+                    self.ip = ip
+                    self.relative_base = relative_base
+                    self.step_counter = steps
+
+                    status = self.fall_back(stop_on_output)
+
+                    memory = self.program
+                    ip = self.ip
+                    relative_base = self.relative_base
+                    steps = self.step_counter
+
+                    if status is not None:
+                        return status
+
+                    continue
+
+                if status == "output":
+                    if stop_on_output:
+                        return OUTPUT
+
+                    continue
+
+                if status == "halt":
+                    self.is_running = False
+                    return HALTED
+
+                if status == "input":
+                    self.is_waiting = True
+                    return INPUT
+
+                # The block wrote into decoded code.
+                self.invalidate(status)
+
+            return BUDGET
+        finally:
+            self.ip = ip
+            self.relative_base = relative_base
+            self.step_counter = steps
+
+
+    def fast_forward(self, header, latch, relative_base, steps, limit):
+        """
+        Skip most of a counted loop, on behalf of an engine which has just
+        jumped back from latch to header.
+
+        If the loop only counts cells up or down by constant amounts, the
+        number of times it will go round again can be worked out directly.
+        Every iteration but the last is skipped by writing the values memory
+        would have at the start of it, leaving the last one to run normally.
+        Returns the step count, including the skipped instructions.
+        """
+
+        loop = self.loop_cache.get(header)
+
+        if loop is None:
+            loop = self.analyse_loop(header, latch, relative_base)
+
+        if not loop or loop["latch"] != latch or loop["relative_base"] != relative_base:
+            return steps
+
+        updates = loop["updates"]
+        deltas = {cell: expression[1] for cell, expression in updates.items() if len(expression) == 2 and expression[0] == cell}
+
+        def value_at(expression, iteration):
+            cell, offset = expression
+
+            if cell is None:
+                return offset
+
+            return self.get_memory_value(cell) + iteration * deltas.get(cell, 0) + offset
+
+        condition = loop["condition"]
+
+        if len(condition) == 3:
+            comparison, left, right = condition
+            start = value_at(left, 0) - value_at(right, 0)
+            step = value_at(left, 1) - value_at(right, 1) - start
+            test = ("<" if comparison == 7 else "==") if loop["jump"] == 5 else (">=" if comparison == 7 else "!=")
+        else:
+            start = value_at(condition, 0)
+            step = value_at(condition, 1) - start
+            test = "!=" if loop["jump"] == 5 else "=="
+
+        iterations = count_loop_iterations(test, start, step)
+
+        if iterations is None:
+            return steps
+
+        # Leave room in the budget for the jump back which got us here.
+        iterations = min(iterations, (limit - steps - 1) // loop["length"])
+
+        if iterations < 1:
+            return steps
+
+        values = {}
+
+        for cell, expression in updates.items():
+            if len(expression) == 3:
+                comparison, left, right = expression
+                left = value_at(left, iterations - 1)
+                right = value_at(right, iterations - 1)
+                values[cell] = int(left < right) if comparison == 7 else int(left == right)
+            else:
+                values[cell] = value_at(expression, iterations - 1)
+
+        for cell, value in values.items():
+            self.set_memory_value(cell, value)
+
+        return steps + iterations * loop["length"]
+
+
+    def analyse_loop(self, header, latch, relative_base):
+        """
+        Work out whether the loop from header to the jump at latch is a
+        counted loop, and remember the answer.
+
+        A counted loop is straight-line adds, multiplies and comparisons
+        ending in the jump, with no input, output or relative base changes,
+        and no writes into itself. Going round once has to add a constant to
+        each cell it updates, or set the cell to something which is the same
+        every time. Comparisons can only be used by the jump.
+
+        The loop is described by a dictionary of the cells it updates, each
+        mapped to an expression for the value it's given in terms of the
+        values at the start of the iteration, and the jump's condition. An
+        expression is either (cell, offset), meaning the cell's value plus an
+        offset (or just the offset, if cell is None), or (comparison, left,
+        right) for the result of a less than or equals. Returns the loop, or
+        False if it isn't a counted loop.
+        """
+
+        updates = {}
+        start_reads = set()
+
+        def operand(mode, parameter):
+            if mode == IMMEDIATE:
+                return (None, parameter)
+
+            cell = parameter + relative_base if mode == RELATIVE else parameter
+
+            if cell in updates:
+                return updates[cell]
+
+            start_reads.add(cell)
+
+            return (cell, 0)
+
+        loop = False
+        address = header
+        length = 0
+
+        while address <= latch:
+            instruction = DECODE_TABLE.get(self.get_memory_value(address))
+
+            if instruction is None:
+                break
+
+            opcode, modes, handler = instruction
+            size = INSTRUCTION_LENGTHS[opcode]
+            parameters = [self.get_memory_value(x) for x in range(address + 1, address + size)]
+            length += 1
+
+            if address == latch:
+                if opcode in (5, 6) and modes[1] == IMMEDIATE and parameters[1] == header:
+                    loop = {
+                        "latch": latch,
+                        "relative_base": relative_base,
+                        "length": length,
+                        "jump": opcode,
+                        "condition": operand(modes[0], parameters[0]),
+                        "updates": updates
+                    }
+
+                break
+
+            if not opcode in (1, 2, 7, 8):
+                break
+
+            a = operand(modes[0], parameters[0])
+            b = operand(modes[1], parameters[1])
+
+            if len(a) == 3 or len(b) == 3:
+                break
+
+            if opcode == 1:
+                if a[0] is not None and b[0] is not None:
+                    break
+
+                value = (b[0] if a[0] is None else a[0], a[1] + b[1])
+            elif opcode == 2:
+                if a[0] is None and b[0] is None:
+                    value = (None, a[1] * b[1])
+                elif b == (None, 1):
+                    value = a
+                elif a == (None, 1):
+                    value = b
+                else:
+                    break
+            else:
+                value = (opcode, a, b)
+
+            dest = parameters[2] + relative_base if modes[2] == RELATIVE else parameters[2]
+
+            if header <= dest < latch + 3:
+                break
+
+            updates[dest] = value
+            address += size
+
+        if loop:
+            for cell, expression in updates.items():
+                if len(expression) == 3:
+                    if cell in start_reads:
+                        loop = False
+                elif expression[0] != cell and expression[0] in updates:
+                    loop = False
+
+            for cell in start_reads:
+                if cell in updates and (len(updates[cell]) == 3 or updates[cell][0] != cell):
+                    loop = False
+
+        self.loop_cache[header] = loop
+        self.add_code_cells(header, latch + 3)
+
+        return loop
+
+
+    def fall_back(self, stop_on_output):
+        """
+        Run the current instruction with step(), on behalf of an engine.
+
+        Returns the status the engine should stop with, or None if it should
+        carry on.
+        """
+
+        opcode = self.get_opcode()
+
+        try:
+            self.step()
+        except IntcodeInputError:
+            return INPUT
+
+        if not self.is_running:
+            return HALTED
+
+        if opcode == 4 and stop_on_output:
+            return OUTPUT
+
+        return None
+
+
+    def compile_block(self, entry):
+        """
+        Compile the basic block starting at an address into a function.
+
+        The block runs straight-line code up to and including the next jump,
+        input, output or halt, with parameter modes and addresses folded into
+        constants. The function takes (memory, relative_base, code_cells,
+        inputs, output) and returns (ip, relative_base, steps, status), where
+        status is None, "output", "halt", "input" when it is starved of input,
+        "step" when an instruction touched unallocated memory, overflowed
+        compact memory or used a negative address and has to be run by step()
+        instead, or the address of a write which landed in decoded code.
+        """
+
+        def read(mode, parameter):
+            if mode == POSITIONAL:
+                return "m[{p}]".format(p=parameter)
+
+            if mode == RELATIVE:
+                use_relative(parameter)
+                return "m[rb + {p}]".format(p=parameter)
+
+            return str(parameter)
+
+        def write(mode, parameter, expression, next_ip, count):
+            if mode == RELATIVE:
+                use_relative(parameter)
+
+            dest = "rb + {p}".format(p=parameter) if mode == RELATIVE else str(parameter)
+
+            return [
+                "d = " + dest,
+                "m[d] = " + expression,
+                "if d in cells: return {ip}, rb, {n}, d".format(ip=next_ip, n=count)
+            ]
+
+        # Lists wrap negative addresses around instead of raising IndexError,
+        # so each run of instructions between changes to the relative base
+        # starts by checking the lowest relative address it's going to use.
+        segment = None
+        lowest = None
+
+        def use_relative(parameter):
+            nonlocal lowest
+
+            lowest = parameter if lowest is None else min(lowest, parameter)
+
+        def guard():
+            if lowest is not None:
+                body.insert(segment, "if rb + {p} < 0: raise IndexError".format(p=lowest))
+
+        body = []
+        addresses = []
+        address = entry
+        count = 0
+
+        while True:
+            instruction = DECODE_TABLE.get(self.get_memory_value(address))
+
+            if instruction is None or count == JIT_MAX_BLOCK_LENGTH:
+                body.append("return {ip}, rb, {n}, None".format(ip=address, n=count))
+                break
+
+            opcode, modes, handler = instruction
+            length = INSTRUCTION_LENGTHS[opcode]
+            parameters = [self.get_memory_value(x) for x in range(address + 1, address + length)]
+            next_ip = address + length
+
+            if any(mode == POSITIONAL and parameter < 0 for mode, parameter in zip(modes, parameters)):
+                body.append("return {ip}, rb, {n}, \"step\"".format(ip=address, n=count))
+                break
+
+            # Keep track of which instruction is running, in case it touches
+            # unallocated memory.
+            body.append("n = {n}".format(n=count))
+            addresses.append(address)
+
+            if segment is None:
+                segment = len(body)
+
+            if opcode == 99:
+                body.append("return {ip}, rb, {n}, \"halt\"".format(ip=address, n=count + 1))
+                break
+
+            if opcode == 3:
+                body.append("if not inputs: return {ip}, rb, {n}, \"input\"".format(ip=address, n=count))
+                lines = write(modes[0], parameters[0], "inputs[0]", next_ip, count + 1)
+                lines.insert(2, "inputs.popleft()")
+                body.extend(lines)
+                body.append("return {ip}, rb, {n}, None".format(ip=next_ip, n=count + 1))
+                break
+
+            a = read(modes[0], parameters[0])
+
+            if opcode == 4:
+                body.append("out({a})".format(a=a))
+                body.append("return {ip}, rb, {n}, \"output\"".format(ip=next_ip, n=count + 1))
+                break
+
+            if opcode == 9:
+                body.append("rb += {a}".format(a=a))
+                guard()
+                segment = None
+                lowest = None
+            else:
+                b = read(modes[1], parameters[1])
+
+                if opcode == 5:
+                    body.append("if {a} != 0: return {b}, rb, {n}, None".format(a=a, b=b, n=count + 1))
+                    body.append("return {ip}, rb, {n}, None".format(ip=next_ip, n=count + 1))
+                    break
+
+                if opcode == 6:
+                    body.append("if {a} == 0: return {b}, rb, {n}, None".format(a=a, b=b, n=count + 1))
+                    body.append("return {ip}, rb, {n}, None".format(ip=next_ip, n=count + 1))
+                    break
+
+                expression = {
+                    1: "{a} + {b}",
+                    2: "{a} * {b}",
+                    7: "1 if {a} < {b} else 0",
+                    8: "1 if {a} == {b} else 0"
+                }[opcode].format(a=a, b=b)
+
+                body.extend(write(modes[2], parameters[2], expression, next_ip, count + 1))
+
+            address = next_ip
+            count += 1
+
+        guard()
+
+        lines = [
+            "def block(m, rb, cells, inputs, out):",
+            "    try:"
+        ]
+
+        lines.extend("        " + line for line in body)
+        lines.append("    except (IndexError, OverflowError):")
+        lines.append("        return {addresses}[n], rb, n, \"step\"".format(addresses=tuple(addresses)))
+
+        namespace = {}
+        exec(compile("\n".join(lines), "<intcode block {entry}>".format(entry=entry), "exec"), namespace)
+        block = namespace["block"]
+
+        self.block_cache[entry] = block
+        self.add_code_cells(entry, address + INSTRUCTION_LENGTHS.get(self.get_memory_value(address) % 100, 1))
+
+        return block
+
+
+    def decode_threaded(self, address):
+        """
+        Decode an instruction into threaded code.
+
+        Returns a tuple of (opcode, mode_a, mode_b, mode_c, a, b, c, second),
+        where a, b and c are the raw parameters. For a fused instruction, the
+        opcode is FUSED plus the opcode of the first half, and second is the
+        tuple for the instruction after it. Otherwise, second is None. Jumps
+        back to a fixed address have LATCH added to their opcodes.
+        """
+
+        instruction = self.build_threaded(lookup_instruction(self.get_memory_value(address)), address)
+
+        if instruction is None:
+            raise IndexError(address)
+
+        opcode = instruction[0]
+        length = INSTRUCTION_LENGTHS[opcode % LATCH]
+
+        if opcode in (1, 2, 7, 8):
+            second = self.decode_fusable(address + 4, instruction)
+
+            if second is not None:
+                instruction = (FUSED + opcode,) + instruction[1:7] + (second,)
+                length += INSTRUCTION_LENGTHS[second[0] % LATCH]
+
+        self.threaded_code[address] = instruction
+        self.add_code_cells(address, address + length)
+
+        return instruction
+
+
+    def decode_fusable(self, address, first):
+        """
+        Decode the instruction which follows another one, if the two can be
+        fused, or return None if they can't.
+
+        Adds and multiplies can be fused with a following add or multiply,
+        and comparisons with a following jump which tests the cell they wrote
+        to. Nothing is fused with an instruction which the first one is known
+        to overwrite. (If it overwrites it through the relative base instead,
+        the engine finds out when it writes and stops before the second half.)
+        """
+
+        instruction = DECODE_TABLE.get(self.get_memory_value(address))
+
+        if instruction is None:
+            return None
+
+        opcode, modes, handler = instruction
+        length = INSTRUCTION_LENGTHS[opcode]
+
+        if first[0] in (1, 2) and not opcode in (1, 2):
+            return None
+
+        if first[0] in (7, 8) and not (opcode in (5, 6) and modes[0] == first[3] and self.get_memory_value(address + 1) == first[6]):
+            return None
+
+        if first[3] == POSITIONAL and address <= first[6] < address + length:
+            return None
+
+        return self.build_threaded(instruction, address)
+
+
+    def build_threaded(self, instruction, address):
+        """
+        Make the threaded code tuple for a decoded, unfused instruction, or
+        return None if it has a negative address as a positional parameter.
+        """
+
+        opcode, modes, handler = instruction
+        length = INSTRUCTION_LENGTHS[opcode]
+        parameters = [self.get_memory_value(x) for x in range(address + 1, address + length)] + [0, 0, 0]
+
+        if any(mode == POSITIONAL and parameter < 0 for mode, parameter in zip(modes, parameters[:length - 1])):
+            return None
+
+        if opcode in (5, 6) and modes[1] == IMMEDIATE and parameters[1] < address:
+            opcode += LATCH
+
+        return (
+            opcode,
+            modes[0],
+            modes[1],
+            modes[2],
+            parameters[0],
+            parameters[1],
+            parameters[2],
+            None
+        )
+
+
+    def has_input(self):
+        """Determine whether there's an input value waiting to be read."""
+
+        return len(self.inputs) > 0
+
+
+    def has_output(self):
+        """Determine whether there's an output value waiting to be read."""
+
+        return len(self.outputs) > 0
+
+
+    def add_input(self, value):
+        """Add a new input value to the queue."""
+
+        self.inputs.append(value)
+
+
+    def add_inputs(self, values):
+        """Add several new input values to the queue, in order."""
+
+        self.inputs.extend(values)
+
+
+    def add_output(self, value):
+        """Add a new output value to the queue."""
+
+        self.outputs.append(value)
+
+
+    def set_inputs(self, inputs):
+        """Populate or overwrite the input queue."""
+
+        self.inputs.clear()
+        self.inputs.extend(inputs)
+
+
+    def get_input(self):
+        """Get the first waiting input value and remove it from the queue."""
+
+        if len(self.inputs) == 0:
+            raise IntcodeInputError("No input available")
+
+        return self.inputs.popleft()
+
+
+    def get_outputs(self):
+        """Get the entire output queue, without removing anything from it."""
+
+        return list(self.outputs)
+
+
+    def drain_outputs(self):
+        """Get the entire output queue and empty it."""
+
+        outputs = list(self.outputs)
+        self.outputs.clear()
+
+        return outputs
+
+
+    def get_output(self):
+        """Get the first waiting output value and remove it from the queue."""
+
+        if len(self.outputs) == 0:
+            raise IntcodeError("No output is available")
+
+        return self.outputs.popleft()
+
+
+    def decode(self):
+        """
+        Decode the instruction at the instruction pointer.
+
+        Returns the DECODE_TABLE entry of (opcode, modes, handler). Decoded
+        instructions are cached by address until something writes over one
+        of their cells.
+        """
+
+        instruction = self.decode_cache.get(self.ip)
+
+        if instruction is not None:
+            return instruction
+
+        instruction = lookup_instruction(self.get_memory_value(self.ip))
+        self.decode_cache[self.ip] = instruction
+        self.add_code_cells(self.ip, self.ip + INSTRUCTION_LENGTHS[instruction[0]])
+
+        return instruction
+
+
+    def add_code_cells(self, start, end):
+        """
+        Remember that something has been decoded from the cells between start
+        and end, and cached under start.
+
+        Each start keeps the furthest end anything under it was decoded up
+        to, so that throwing it away can clear it from all of its cells.
+        """
+
+        for cell in range(start, end):
+            self.code_cells.setdefault(cell, set()).add(start)
+
+        if end > self.code_ends.get(start, start):
+            self.code_ends[start] = end
+
+
+    def invalidate(self, address):
+        """Forget any decoded instructions which use a memory address."""
+
+        for start in self.code_cells.pop(address, ()):
+            for cell in range(start, self.code_ends.pop(start)):
+                starts = self.code_cells.get(cell)
+
+                if starts is not None:
+                    starts.discard(start)
+
+                    if not starts:
+                        del self.code_cells[cell]
+
+            self.decode_cache.pop(start, None)
+            self.threaded_code.pop(start, None)
+            self.loop_cache.pop(start, None)
+
+            # A thrown away block has to get hot again before it's recompiled.
+            if self.block_cache.pop(start, None) is not None:
+                self.block_hits.pop(start, None)
+                self.block_deopts[start] = self.block_deopts.get(start, 0) + 1
+
+
+    def get_opcode(self):
+        """Get the current opcode, without parameter mode information."""
+
+        return self.decode()[0]
+
+
+    def get_parameter_modes(self):
+        """
+        Get the parameter modes for the current instruction.
+
+        Each mode is one of POSITIONAL, IMMEDIATE or RELATIVE.
+        """
+
+        return self.decode()[1]
+
+
+    def get_parameters(self, count):
+        """
+        Get the parameters for the current opcode, respecting parameter
+        modes.
+        """
+
+        parameters = []
+        modes = self.get_parameter_modes()
+        address = self.ip + 1
+
+        for i in range(count):
+            value = self.get_memory_value(address)
+
+            if modes[i] == POSITIONAL:
+                value = self.get_memory_value(value)
+
+            if modes[i] == RELATIVE:
+                value = self.get_memory_value(self.relative_base + value)
+
+            parameters.append(value)
+            address += 1
+
+        return parameters
+
+
+    def allocate(self, address, writing = False):
+        """
+        Make sure a memory address is backed by storage, and return the page
+        holding it along with the address's offset in that page.
+
+        Addresses below DENSE_MEMORY_LIMIT live in self.program, which is
+        grown a page of zeroes at a time. Anything above that lives in a
+        sparse dictionary of pages. Pages shared with a snapshot are copied
+        before they're grown or written to, and sparse pages which are written
+        to are remembered for the next checkpoint.
+        """
+
+        if address < 0:
+            raise IntcodeError("Negative memory address: {address}".format(address=address))
+
+        if address < DENSE_MEMORY_LIMIT:
+            if self.program_is_shared and (writing or address >= len(self.program)):
+                self.unshare_program()
+
+            if address >= len(self.program):
+                size = (address // PAGE_SIZE + 1) * PAGE_SIZE
+                self.program.extend([0] * (size - len(self.program)))
+
+            return self.program, address
+
+        page_number = address // PAGE_SIZE
+
+        if not page_number in self.pages:
+            self.pages[page_number] = self.new_page()
+        elif writing and page_number in self.shared_pages:
+            self.pages[page_number] = self.pages[page_number][:]
+            self.shared_pages.remove(page_number)
+
+        if writing:
+            self.dirty_pages.add(page_number)
+
+        return self.pages[page_number], address % PAGE_SIZE
+
+
+    def unshare_program(self):
+        """Take a private copy of the program image."""
+
+        self.program = self.program[:]
+        self.program_is_shared = False
+
+
+    def new_page(self):
+        """Create a page of zeroes to suit the kind of memory in use."""
+
+        if self.compact:
+            return array("q", [0]) * PAGE_SIZE
+
+        return [0] * PAGE_SIZE
+
+
+    def promote(self):
+        """Switch compact memory over to lists, so it can hold any integer."""
+
+        self.program = list(self.program)
+
+        for page_number in self.pages:
+            self.pages[page_number] = list(self.pages[page_number])
+
+        self.compact = False
+        self.program_is_shared = False
+        self.shared_pages = set()
+
+
+    def get_memory_value(self, address):
+        """Peek at the value in a memory address."""
+
+        if 0 <= address < len(self.program):
+            return self.program[address]
+
+        if address >= DENSE_MEMORY_LIMIT:
+            page = self.pages.get(address // PAGE_SIZE)
+
+            return page[address % PAGE_SIZE] if page else 0
+
+        page, offset = self.allocate(address)
+
+        return page[offset]
+
+
+    def set_memory_value(self, address, value):
+        """Poke a value into a memory address."""
+
+        page, offset = self.allocate(address, writing = True)
+
+        try:
+            page[offset] = value
+        except OverflowError:
+            self.promote()
+
+            page, offset = self.allocate(address, writing = True)
+            page[offset] = value
+
+        if address in self.code_cells:
+            self.invalidate(address)
+
+
+    def jump(self, address):
+        """Move the instruction pointer to the specified address."""
+
+        self.ip = address
+
+
+    def jump_rel(self, delta):
+        """Move the instruction pointer by the specified delta."""
+
+        self.ip = self.ip + delta
+
+
+    def halt(self):
+        """Halt execution."""
+
+        if not self.is_running:
+            raise IntcodeError("Program is not running")
+
+        self.is_running = False
+
+
+    def step(self):
+        """Run the next single instruction."""
+
+        if not self.is_running:
+            raise IntcodeError("Program has halted")
+
+        opcode, modes, handler = self.decode()
+
+        if self.debugging:
+            self.debug()
+
+        self.is_waiting = False
+
+        handler(self)
+        self.step_counter += 1
+
+
+    def debug(self):
+        print ("")
+        print ("Machine:", self.name)
+        print ("IP:", self.ip)
+        print ("Relative base:", self.relative_base)
+        print ("Inputs:", list(self.inputs))
+        print ("Outputs:", list(self.outputs))
+        print ("Status:", "running" if self.is_running else "not running", "waiting" if self.is_waiting else "not waiting")
+
+        for x in range(len(self.program)):
+            print ("* " if x == self.ip else "  ", x, "] ", self.program[x], sep = "")
+
+            if x > 18:
+                break
+
+        input ("Press enter to continue")
+
+
+    def add(self):
+        """Add."""
+
+        parameters = self.get_parameters(2)
+        dest = self.get_memory_value(self.ip + 3)
+
+        modes = self.get_parameter_modes()
+
+        if modes[2] == RELATIVE:
+            dest += self.relative_base
+
+        value = parameters[0] + parameters[1]
+
+        self.set_memory_value(dest, value)
+        self.jump_rel(4)
+
+
+    def multiply(self):
+        """Multiply."""
+
+        parameters = self.get_parameters(2)
+        dest = self.get_memory_value(self.ip + 3)
+
+        modes = self.get_parameter_modes()
+
+        if modes[2] == RELATIVE:
+            dest += self.relative_base
+
+        value = parameters[0] * parameters[1]
+
+        self.set_memory_value(dest, value)
+        self.jump_rel(4)
+
+
+    def input(self):
+        """Input."""
+
+        if not self.has_input():
+            self.is_waiting = True
+
+            raise IntcodeInputError("No input available")
+
+        dest = self.get_memory_value(self.ip + 1)
+        modes = self.get_parameter_modes()
+
+        if modes[0] == RELATIVE:
+            dest += self.relative_base
+
+        value = self.get_input()
+
+        self.set_memory_value(dest, value)
+        self.jump_rel(2)
+
+
+    def output(self):
+        """Output."""
+
+        parameters = self.get_parameters(1)
+        value = parameters[0]
+
+        self.add_output(value)
+        self.jump_rel(2)
+
+
+    def jump_if_true(self):
+        """Jump if true."""
+
+        parameters = self.get_parameters(2)
+        value = parameters[0]
+        dest = parameters[1]
+
+        if value != 0:
+            self.jump(dest)
+        else:
+            self.jump_rel(3)
+
+
+    def jump_if_false(self):
+        """Jump if false."""
+
+        parameters = self.get_parameters(2)
+        value = parameters[0]
+        dest = parameters[1]
+
+        if value == 0:
+            self.jump(dest)
+        else:
+            self.jump_rel(3)
+
+
+    def set_if_less_than(self):
+        """Set if less than."""
+
+        parameters = self.get_parameters(2)
+        dest = self.get_memory_value(self.ip + 3)
+
+        modes = self.get_parameter_modes()
+
+        if modes[2] == RELATIVE:
+            dest += self.relative_base
+
+        value = 1 if parameters[0] < parameters[1] else 0
+
+        self.set_memory_value(dest, value)
+        self.jump_rel(4)
+
+
+    def set_if_equal(self):
+        """Set if equal."""
+
+        parameters = self.get_parameters(2)
+        dest = self.get_memory_value(self.ip + 3)
+
+        modes = self.get_parameter_modes()
+
+        if modes[2] == RELATIVE:
+            dest += self.relative_base
+
+        value = 1 if parameters[0] == parameters[1] else 0
+
+        self.set_memory_value(dest, value)
+        self.jump_rel(4)
+
+
+    def relative_base_offset(self):
+        """Adjust relative base."""
+        parameters = self.get_parameters(1)
+        offset = parameters[0]
+
+        self.relative_base += offset
+        self.jump_rel(2)
+
+
+    def halt(self):
+        self.is_running = False
+
+
+def build_decode_table():
+    """
+    Build a table of every legal instruction word.
+
+    Each word maps to a tuple of (opcode, modes, handler), where modes always
+    has three entries and handler is the unbound IntcodeMachine method.
+    Parameters which are written to can't be in immediate mode.
+    """
+
+    handlers = {
+        1: IntcodeMachine.add,
+        2: IntcodeMachine.multiply,
+        3: IntcodeMachine.input,
+        4: IntcodeMachine.output,
+        5: IntcodeMachine.jump_if_true,
+        6: IntcodeMachine.jump_if_false,
+        7: IntcodeMachine.set_if_less_than,
+        8: IntcodeMachine.set_if_equal,
+        9: IntcodeMachine.relative_base_offset,
+        99: IntcodeMachine.halt
+    }
+
+    writes = (1, 2, 3, 7, 8)
+    table = {}
+
+    for opcode, length in INSTRUCTION_LENGTHS.items():
+        count = length - 1
+
+        for modes in product((POSITIONAL, IMMEDIATE, RELATIVE), repeat = count):
+            if opcode in writes and modes[-1] == IMMEDIATE:
+                continue
+
+            word = opcode
+
+            for i, mode in enumerate(modes):
+                word += mode * 10 ** (i + 2)
+
+            table[word] = (opcode, modes + (POSITIONAL,) * (3 - count), handlers[opcode])
+
+    return table
+
+
+DECODE_TABLE = build_decode_table()
+
+
+def lookup_instruction(word):
+    """Look up an instruction word in the decode table."""
+
+    instruction = DECODE_TABLE.get(word)
+
+    if instruction is None:
+        raise IntcodeError("Unknown instruction: {word}".format(word=word))
+
+    return instruction
+
+
+def read_checkpoint_slot(mapped):
+    """
+    Find the current slot in the contents of a checkpoint file.
+
+    Returns the generation, and the offset and length of the record the slot
+    points to, or None if neither slot is valid.
+    """
+
+    current = None
+
+    for offset in (0, CHECKPOINT_SLOT.size):
+        if len(mapped) < offset + CHECKPOINT_SLOT.size:
+            break
+
+        magic, generation, record_offset, record_length, record_crc, slot_crc = CHECKPOINT_SLOT.unpack_from(mapped, offset)
+
+        if magic != CHECKPOINT_MAGIC or slot_crc != zlib.crc32(mapped[offset:offset + CHECKPOINT_SLOT.size - 4]):
+            continue
+
+        if record_offset + record_length > len(mapped) or record_crc != zlib.crc32(mapped[record_offset:record_offset + record_length]):
+            continue
+
+        if current is None or generation > current[0]:
+            current = (generation, record_offset, record_length)
+
+    return current
+
+
+def checkpoint_file_id(path):
+    """Identify a file by its device and inode."""
+
+    status = os.stat(path)
+
+    return status.st_dev, status.st_ino
+
+
+def checkpoint_is_current(path, saved):
+    """Check whether a file still holds the checkpoint a machine last saved."""
+
+    try:
+        with open(path, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as mapped:
+                slot = read_checkpoint_slot(mapped)
+
+        file_id = checkpoint_file_id(path)
+    except (OSError, ValueError):
+        return False
+
+    return slot is not None and slot[0] == saved["generation"] and file_id == saved["file"]
+
+
+def count_loop_iterations(test, start, step):
+    """
+    Count how many more times a loop goes round, if it stops when a value
+    which starts at start and changes by step each time fails a test against
+    zero ("<", ">=", "==" or "!="). Returns None if it never stops.
+    """
+
+    if test == "<":
+        if start >= 0:
+            return 0
+
+        return None if step <= 0 else (step - start - 1) // step
+
+    if test == ">=":
+        if start < 0:
+            return 0
+
+        return None if step >= 0 else start // -step + 1
+
+    if test == "==":
+        if start != 0:
+            return 0
+
+        return None if step == 0 else 1
+
+    if start == 0:
+        return 0
+
+    if step == 0 or -start % step != 0 or -start // step < 0:
+        return None
+
+    return -start // step
+
+
+class BatchIntcodeMachine:
+    """
+    Runs many copies of one program in lockstep, one NumPy row of memory per
+    instance.
+
+    Each pass picks the lowest instruction pointer among the instances which
+    can run, and executes that instruction for every instance sitting on it
+    with vectorised reads and writes. The others are masked out until control
+    flow brings them back together. Memory is 64-bit, so anything which
+    overflows raises an IntcodeError rather than wrapping. There's no sparse
+    memory, so addresses have to be below DENSE_MEMORY_LIMIT.
+    """
+
+    def __init__(self, program, count, inputs = None):
+        if numpy is None:
+            raise IntcodeError("BatchIntcodeMachine needs NumPy")
+
+        size = (len(program) // PAGE_SIZE + 1) * PAGE_SIZE
+
+        try:
+            self.memory = numpy.zeros((count, size), dtype = numpy.int64)
+            self.memory[:, :len(program)] = program
+        except OverflowError:
+            raise IntcodeError("Program doesn't fit in 64-bit memory")
+
+        self.count = count
+        self.ip = numpy.zeros(count, dtype = numpy.int64)
+        self.relative_base = numpy.zeros(count, dtype = numpy.int64)
+        self.step_counter = numpy.zeros(count, dtype = numpy.int64)
+        self.is_running = numpy.ones(count, dtype = bool)
+        self.is_waiting = numpy.zeros(count, dtype = bool)
+        self.inputs = [deque(values) for values in (inputs or [[]] * count)]
+        self.outputs = [[] for x in range(count)]
+
+
+    def set_memory_value(self, address, values):
+        """Poke a value, or one value per instance, into a memory address."""
+
+        self.allocate(numpy.array([address]))
+        self.memory[:, address] = values
+
+
+    def get_memory_values(self, address):
+        """Get the value of a memory address in every instance."""
+
+        self.allocate(numpy.array([address]))
+
+        return self.memory[:, address].tolist()
+
+
+    def add_input(self, index, value):
+        """Add a new input value to one instance's queue."""
+
+        self.inputs[index].append(value)
+        self.is_waiting[index] = False
+
+
+    def allocate(self, addresses):
+        """Grow every instance's memory to cover some addresses."""
+
+        if len(addresses) == 0:
+            return
+
+        if addresses.min() < 0:
+            raise IntcodeError("Negative memory address")
+
+        highest = int(addresses.max())
+
+        # Every instance gets every cell up to the highest, so one far out
+        # address would take gigabytes.
+        if highest >= DENSE_MEMORY_LIMIT:
+            raise IntcodeError("Memory address too high for a batch: {address}".format(address=highest))
+
+        if highest >= self.memory.shape[1]:
+            size = (highest // PAGE_SIZE + 1) * PAGE_SIZE
+            grown = numpy.zeros((self.count, size), dtype = numpy.int64)
+            grown[:, :self.memory.shape[1]] = self.memory
+            self.memory = grown
+
+
+    def read(self, lanes, address, mode):
+        """Read a parameter for a group of instances."""
+
+        self.allocate(numpy.array([address]))
+        value = self.memory[lanes, address]
+
+        if mode == IMMEDIATE:
+            return value
+
+        if mode == RELATIVE:
+            value = value + self.relative_base[lanes]
+
+        self.allocate(value)
+
+        return self.memory[lanes, value]
+
+
+    def destination(self, lanes, address, mode):
+        """Work out where a group of instances will write to."""
+
+        self.allocate(numpy.array([address]))
+        dest = self.memory[lanes, address]
+
+        if mode == RELATIVE:
+            dest = dest + self.relative_base[lanes]
+
+        self.allocate(dest)
+
+        return dest
+
+
+    def run(self):
+        """
+        Run every instance until it halts or needs input it doesn't have.
+
+        Returns a list of outputs for each instance.
+        """
+
+        while True:
+            lanes = numpy.flatnonzero(self.is_running & ~self.is_waiting)
+
+            if len(lanes) == 0:
+                return self.outputs
+
+            ips = self.ip[lanes]
+            ip = int(ips.min())
+            lanes = lanes[ips == ip]
+
+            # Self-modifying code can leave different instructions at the
+            # same address in different instances.
+            words = self.memory[lanes, ip]
+            word = int(words[0])
+            lanes = lanes[words == word]
+
+            self.step(lanes, ip, word)
+
+
+    def step(self, lanes, ip, word):
+        """Run one instruction for a group of instances at the same address."""
+
+        opcode, modes, handler = lookup_instruction(word)
+
+        if opcode == 99:
+            self.is_running[lanes] = False
+            self.step_counter[lanes] += 1
+            return
+
+        if opcode == 3:
+            dest = self.destination(lanes, ip + 1, modes[0])
+
+            for lane, address in zip(lanes.tolist(), dest.tolist()):
+                if not self.inputs[lane]:
+                    self.is_waiting[lane] = True
+                    continue
+
+                self.memory[lane, address] = self.inputs[lane].popleft()
+                self.ip[lane] += 2
+                self.step_counter[lane] += 1
+
+            return
+
+        a = self.read(lanes, ip + 1, modes[0])
+
+        if opcode == 4:
+            for lane, value in zip(lanes.tolist(), a.tolist()):
+                self.outputs[lane].append(value)
+
+            self.ip[lanes] += 2
+        elif opcode == 9:
+            self.relative_base[lanes] += a
+            self.ip[lanes] += 2
+        else:
+            b = self.read(lanes, ip + 2, modes[1])
+
+            if opcode == 5:
+                self.ip[lanes] = numpy.where(a != 0, b, ip + 3)
+            elif opcode == 6:
+                self.ip[lanes] = numpy.where(a == 0, b, ip + 3)
+            else:
+                if opcode == 1:
+                    value = a + b
+                    overflowed = ((a ^ value) & (b ^ value)) < 0
+                elif opcode == 2:
+                    value = a * b
+                    overflowed = (a != 0) & (value // numpy.where(a == 0, 1, a) != b)
+                elif opcode == 7:
+                    value = (a < b).astype(numpy.int64)
+                    overflowed = None
+                else:
+                    value = (a == b).astype(numpy.int64)
+                    overflowed = None
+
+                if overflowed is not None and overflowed.any():
+                    raise IntcodeError("Value overflowed 64-bit memory at {ip}".format(ip=ip))
+
+                dest = self.destination(lanes, ip + 3, modes[2])
+                self.memory[lanes, dest] = value
+                self.ip[lanes] += 4
+
+        self.step_counter[lanes] += 1
+
+
+def testIntcodeMachine():
+    """Run sample I/O from AoC questions"""
+
+    tests = [
+            {
+                "name": "nop",
+                "program": [1002, 4, 3, 0, 99],
+                "inputs": [],
+                "outputs": []
+             },
+             {
+                 "name": "print input",
+                 "program": [3, 0, 4, 0, 99],
+                 "inputs": [123],
+                 "outputs": [123]
+             },
+             {
+                 "name": "is non-zero (position mode)",
+                 "program": [3,12,6,12,15,1,13,14,13,4,13,99,-1,0,1,9],
+                 "inputs": [123],
+                 "outputs": [1]
+             },
+             {
+                 "name": "is non-zero (position mode, negated)",
+                 "program": [3,12,6,12,15,1,13,14,13,4,13,99,-1,0,1,9],
+                 "inputs": [0],
+                 "outputs": [0]
+             },
+             {
+                 "name": "is non-zero (immediate mode)",
+                 "program": [3,3,1105,-1,9,1101,0,0,12,4,12,99,1],
+                 "inputs": [123],
+                 "outputs": [1]
+             },
+             {
+                 "name": "is non-zero (immediate mode, negated)",
+                 "program": [3,3,1105,-1,9,1101,0,0,12,4,12,99,1],
+                 "inputs": [0],
+                 "outputs": [0]
+             },
+             {
+                 "name": "day 5 larger example (less than 8)",
+                 "program": [3,21,1008,21,8,20,1005,20,22,107,8,21,20,1006,20,31,1106,0,36,98,0,0,1002,21,125,20,4,20,1105,1,46,104,999,1105,1,46,1101,1000,1,20,4,20,1105,1,46,98,99],
+                 "inputs": [4],
+                 "outputs": [999]
+             },
+             {
+                 "name": "day 5 larger example (equal 8)",
+                 "program": [3,21,1008,21,8,20,1005,20,22,107,8,21,20,1006,20,31,1106,0,36,98,0,0,1002,21,125,20,4,20,1105,1,46,104,999,1105,1,46,1101,1000,1,20,4,20,1105,1,46,98,99],
+                 "inputs": [8],
+                 "outputs": [1000]
+             },
+             {
+                 "name": "day 5 larger example (greater than 8)",
+                 "program": [3,21,1008,21,8,20,1005,20,22,107,8,21,20,1006,20,31,1106,0,36,98,0,0,1002,21,125,20,4,20,1105,1,46,104,999,1105,1,46,1101,1000,1,20,4,20,1105,1,46,98,99],
+                 "inputs": [10],
+                 "outputs": [1001]
+             },
+             {
+                 "name": "self-modifying (operand)",
+                 "program": [104,7,1001,1,1,1,1008,1,9,30,1006,30,0,99],
+                 "inputs": [],
+                 "outputs": [7,8]
+             },
+             {
+                 "name": "self-modifying (hot loop)",
+                 "program": [1101,0,0,30,1001,1,1,1,1007,1,20,31,1005,31,0,4,30,99],
+                 "inputs": [],
+                 "outputs": [19]
+             },
+             {
+                 "name": "sparse memory",
+                 "program": [1101,7,0,1000000000,4,1000000000,4,999999999,99],
+                 "inputs": [],
+                 "outputs": [7,0]
+             },
+             {
+                 "name": "growing memory (hot loop)",
+                 "program": [109,1,21101,1,0,2000,1001,30,1,30,1007,30,3000,31,1005,31,0,204,1999,4,30,99,0,0,0,0,0,0,0,0,0,0],
+                 "inputs": [],
+                 "outputs": [1,3000]
+             },
+             {
+                 "name": "bigint promotion",
+                 "program": [1102,3037000500,3037000500,7,4,7,99,0],
+                 "inputs": [],
+                 "outputs": [9223372037000250000]
+             },
+             {
+                 "name": "bigint promotion (hot loop)",
+                 "program": [1002,30,2,30,1001,31,1,31,1007,31,70,32,1005,32,0,4,30,99,0,0,0,0,0,0,0,0,0,0,0,0,1,0,0],
+                 "inputs": [],
+                 "outputs": [1180591620717411303424]
+             },
+             {
+                 "name": "day 9 (quine)",
+                 "program": [109,1,204,-1,1001,100,1,100,1008,100,16,101,1006,101,0,99],
+                 "inputs": [],
+                 "outputs": [109,1,204,-1,1001,100,1,100,1008,100,16,101,1006,101,0,99]
+             },
+             {
+                 "name": "day 9 (16-digit number)",
+                 "program": [1102,34915192,34915192,7,4,7,99,0],
+                 "inputs": [],
+                 "outputs": 'special-16-digit'
+             },
+             {
+                 "name": "day 9 (large number)",
+                 "program": [104,1125899906842624,99],
+                 "inputs": [],
+                 "outputs": [1125899906842624]
+             }
+        ]
+
+    overall_success = True
+
+    for test in tests:
+        for engine, compact in product(ENGINES, (False, True)):
+            print ("Testing \"", test["name"], "\" (", engine, ", compact" if compact else "", "), ", test["inputs"], " -> ", test["outputs"], sep="")
+
+            machine = IntcodeMachine(verbose = False, debugging = "debugging" in test, engine = engine, compact = compact)
+            machine.set_program(test['program'])
+            machine.set_inputs(test['inputs'].copy())
+
+            try:
+                machine.run()
+            except IntcodeError as error:
+                print ("Fail: got IntcodeError", error)
+                overall_success = False
+                print ("--")
+                continue
+
+            result = machine.get_outputs()
+
+            special = False
+
+            if test['outputs'] == 'special-16-digit' and len(str(result[0])) == 16:
+                special = True
+
+            if result == test["outputs"] or special:
+                print ("Pass")
+            else:
+                print ("Fail: got ", result)
+                overall_success = False
+                exit()
+
+            print ("--")
+
+
+    return overall_success
+
+
+def testRunUntil():
+    """Check that run_until() stops in the right places on every engine."""
+
+    echo = [3,0,4,0,4,0,99]
+    quine = [109,1,204,-1,1001,100,1,100,1008,100,16,101,1006,101,0,99]
+
+    tests = [
+            {
+                "name": "echo",
+                "program": echo,
+                "calls": [(OUTPUT, None), ("add_input", 5), (OUTPUT, None), (OUTPUT, None), (OUTPUT, None)],
+                "statuses": [INPUT, OUTPUT, OUTPUT, HALTED],
+                "outputs": [5, 5]
+            },
+            {
+                "name": "echo (until input)",
+                "program": echo,
+                "calls": [(INPUT, None), ("add_input", 5), (INPUT, None)],
+                "statuses": [INPUT, HALTED],
+                "outputs": [5, 5]
+            },
+            {
+                "name": "quine (budget)",
+                "program": quine,
+                "calls": [(HALTED, 50), (HALTED, 30), (HALTED, None)],
+                "statuses": [BUDGET, BUDGET, HALTED],
+                "steps": [50, 80, 81],
+                "outputs": quine
+            },
+            {
+                # Hot enough to compile just before the first budget runs out.
+                "name": "endless counter (budget)",
+                "program": [1001,20,1,20,1105,1,0,99] + [0] * 20,
+                "calls": [(HALTED, 15), (HALTED, 200), (HALTED, 15)],
+                "statuses": [BUDGET, BUDGET, BUDGET],
+                "steps": [15, 215, 230],
+                "outputs": []
+            }
+        ]
+
+    overall_success = True
+
+    for test in tests:
+        for engine in ENGINES:
+            print ("Testing run_until \"", test["name"], "\" (", engine, ")", sep="")
+
+            machine = IntcodeMachine(engine = engine)
+            machine.set_program(test["program"])
+
+            statuses = []
+            steps = []
+
+            for event, argument in test["calls"]:
+                if event == "add_input":
+                    machine.add_input(argument)
+                    continue
+
+                statuses.append(machine.run_until(event, budget = argument))
+                steps.append(machine.step_counter)
+
+            if statuses != test["statuses"] or machine.get_outputs() != test["outputs"]:
+                print ("Fail: got", statuses, machine.get_outputs())
+                overall_success = False
+            elif "steps" in test and steps != test["steps"]:
+                print ("Fail: got step counts", steps)
+                overall_success = False
+            else:
+                print ("Pass")
+
+    print ("--")
+
+    return overall_success
+
+
+def testNegativeAddresses():
+    """Check every engine refuses negative addresses instead of wrapping."""
+
+    tests = [
+            {
+                "name": "output from -1",
+                "program": [4,-1,99],
+                "inputs": [],
+                "outputs": []
+            },
+            {
+                "name": "write to -2",
+                "program": [1101,5,5,-2,4,3,99],
+                "inputs": [],
+                "outputs": []
+            },
+            {
+                "name": "input through the relative base",
+                "program": [109,-1,203,0,99],
+                "inputs": [5],
+                "outputs": []
+            },
+            {
+                # Hot enough to be compiled before it walks off the bottom.
+                "name": "relative base counting down",
+                "program": [109,20,204,0,109,-1,1105,1,2] + [0] * 12,
+                "inputs": [],
+                "outputs": [0] * 12 + [2,1,1105,-1,109,0,204,20,109]
+            }
+        ]
+
+    overall_success = True
+
+    for test in tests:
+        for engine, compact in product(ENGINES, (False, True)):
+            print ("Testing negative addresses \"", test["name"], "\" (", engine, ", compact" if compact else "", ")", sep="")
+
+            machine = IntcodeMachine(engine = engine, compact = compact)
+            machine.set_program(test["program"])
+            machine.add_inputs(test["inputs"])
+
+            try:
+                machine.run()
+                print ("Fail: no IntcodeError")
+                overall_success = False
+                continue
+            except IntcodeError:
+                pass
+
+            memory = [machine.get_memory_value(x) for x in range(len(test["program"]))]
+
+            if machine.get_outputs() == test["outputs"] and memory == test["program"]:
+                print ("Pass")
+            else:
+                print ("Fail: got", machine.get_outputs(), memory)
+                overall_success = False
+
+    print ("--")
+
+    return overall_success
+
+
+def testQueues():
+    """Stream a long run of values through an echo program on every engine."""
+
+    # Echo each input until a zero arrives.
+    program = [3,100,4,100,1005,100,0,99]
+    values = list(range(1, 20001))
+
+    overall_success = True
+
+    for engine in ENGINES:
+        print ("Testing queues (", engine, ")", sep="")
+
+        machine = IntcodeMachine(engine = engine)
+        machine.set_program(program)
+        machine.add_inputs(values)
+        machine.add_input(0)
+        machine.run()
+
+        result = machine.drain_outputs()
+
+        if result == values + [0] and not machine.has_output():
+            print ("Pass")
+        else:
+            print ("Fail: got", len(result), "values")
+            overall_success = False
+
+    print ("--")
+
+    return overall_success
+
+
+def testExecute():
+    """Drive machines as generators, on their own and chained together."""
+
+    # Double each input and output it, forever.
+    doubler = [3,11,1002,11,2,11,4,11,1105,1,0,0]
+    quine = [109,1,204,-1,1001,100,1,100,1008,100,16,101,1006,101,0,99]
+
+    overall_success = True
+
+    for engine in ENGINES:
+        print ("Testing execute (", engine, ")", sep="")
+
+        machine = IntcodeMachine(engine = engine)
+        machine.set_program(quine)
+        copied = list(machine.execute())
+
+        machines = [IntcodeMachine(engine = engine) for i in range(3)]
+        pipeline = []
+
+        for machine in machines:
+            machine.set_program(doubler)
+            pipeline.append(machine.execute())
+            next(pipeline[-1])
+
+        chained = []
+
+        for value in range(1, 6):
+            for stage in pipeline:
+                value = stage.send(value)
+                next(stage)
+
+            chained.append(value)
+
+        # Queue input while the generator is waiting, instead of sending it.
+        machine = IntcodeMachine(engine = engine)
+        machine.set_program(doubler)
+        generator = machine.execute()
+        next(generator)
+        machine.add_input(21)
+        queued = next(generator)
+
+        if copied == quine and chained == [8, 16, 24, 32, 40] and queued == 42:
+            print ("Pass")
+        else:
+            print ("Fail: got", copied, chained, queued)
+            overall_success = False
+
+    print ("--")
+
+    return overall_success
+
+
+def testProfiler():
+    """Profile a small counting loop and check the counts add up."""
+
+    # Count down from 5, outputting each value.
+    program = [1101,5,0,20,4,20,1001,20,-1,20,1005,20,4,99]
+
+    overall_success = True
+
+    for engine in ENGINES:
+        print ("Testing profiler (", engine, ")", sep="")
+
+        machine = IntcodeMachine(engine = engine)
+        machine.set_program(program)
+        profile = machine.enable_profiling()
+        machine.run()
+
+        counts = json.loads(profile.to_json())
+        expected = {
+            "steps": 17,
+            "opcodes": {"output": 5, "add": 6, "jump if true": 5, "halt": 1},
+            "instructions": {"4": 5, "1001": 5, "1005": 5, "1101": 1, "99": 1},
+            "jumps": {"10": {"taken": 4, "not taken": 1}}
+        }
+
+        success = machine.get_outputs() == [5, 4, 3, 2, 1] and machine.step_counter == 17
+        success = success and all(counts[key] == value for key, value in expected.items())
+        success = success and counts["addresses"]["4"] == 5 and "Instructions executed: 17" in profile.report()
+
+        # Once it's off, the machine runs on its own engine again.
+        machine.disable_profiling()
+        machine.set_program(program)
+        machine.run()
+
+        if success and machine.get_outputs() == [5, 4, 3, 2, 1] and profile.steps == 17:
+            print ("Pass")
+        else:
+            print ("Fail: got", counts)
+            overall_success = False
+
+    print ("--")
+
+    return overall_success
+
+
+def testTracing():
+    """Trace a loop into a small ring buffer and decode what's left in it."""
+
+    # Count down from 5, outputting each value, then work out a value too
+    # big for the trace's array and store it out of the way.
+    program = [109,100,1101,5,0,20,4,20,1001,20,-1,20,1005,20,6,21102,4294967296,4294967296,1,99]
+
+    expected = [
+        "      12: 1005   jump if true         [20, 6] -> 15",
+        "      15: 21102  multiply             [4294967296, 4294967296, 1] -> [101] = 18446744073709551616",
+        "      19: 99     halt                 []"
+    ]
+
+    overall_success = True
+
+    for engine in ENGINES:
+        print ("Testing tracing (", engine, ")", sep="")
+
+        machine = IntcodeMachine(engine = engine)
+        machine.set_program(program)
+        trace = machine.enable_tracing(3)
+        machine.run()
+
+        full = IntcodeMachine(engine = engine)
+        full.set_program(program)
+        full_trace = full.enable_tracing()
+        full.run()
+
+        lines = format_trace(full_trace)
+        success = format_trace(trace) == expected and len(lines) == full.step_counter == 19
+        success = success and lines[0] == "       0: 109    relative base offset [100] -> 100"
+        success = success and lines[2] == "       6: 4      output               [20] -> 5"
+        success = success and lines[3] == "       8: 1001   add                  [20, -1, 20] -> [20] = 4"
+
+        if success and machine.get_outputs() == [5, 4, 3, 2, 1]:
+            print ("Pass")
+        else:
+            print ("Fail: got", format_trace(trace), lines[:4])
+            overall_success = False
+
+    print ("--")
+
+    return overall_success
+
+
+def testInvalidation():
+    """Check that throwing away decoded code leaves nothing behind."""
+
+    # Count up in an immediate operand of the comparison, 5000 times.
+    program = [1001,5,1,5,1107,0,5000,20,1005,20,0,4,5,99] + [0] * 10
+
+    overall_success = True
+
+    for engine in ENGINES:
+        print ("Testing invalidation of a self-modifying loop (", engine, ")", sep="")
+
+        machine = IntcodeMachine(engine = engine)
+        machine.set_program(program)
+        machine.run()
+
+        cached = set(machine.decode_cache) | set(machine.threaded_code) | set(machine.block_cache) | set(machine.loop_cache)
+        starts = set().union(*machine.code_cells.values())
+
+        if machine.get_outputs() == [5000] and starts == cached == set(machine.code_ends):
+            print ("Pass")
+        else:
+            print ("Fail: got", machine.get_outputs(), machine.code_cells, cached)
+            overall_success = False
+
+    print ("--")
+
+    return overall_success
+
+
+def testDeoptimisation():
+    """Check the JIT engine gives up on blocks which keep being rewritten."""
+
+    # Count up in an immediate operand of the comparison, 5000 times.
+    program = [1001,5,1,5,1107,0,5000,20,1005,20,0,4,5,99] + [0] * 10
+
+    print ("Testing deoptimisation of a self-modifying loop")
+
+    machine = IntcodeMachine(engine = "jit")
+    machine.set_program(program)
+
+    compiled = []
+    compile_block = machine.compile_block
+    machine.compile_block = lambda entry: compiled.append(entry) or compile_block(entry)
+
+    machine.run()
+
+    reference = IntcodeMachine()
+    reference.set_program(program)
+    reference.run()
+
+    success = machine.get_outputs() == reference.get_outputs() == [5000]
+    success = success and machine.step_counter == reference.step_counter
+
+    if success and all(compiled.count(entry) <= JIT_MAX_DEOPTS for entry in compiled):
+        print ("Pass")
+    else:
+        print ("Fail: got", machine.get_outputs(), compiled, machine.block_deopts)
+        return False
+
+    print ("--")
+
+    return True
+
+
+def testFusion():
+    """Check fused instructions behave just like the ones they replace."""
+
+    tests = [
             {
-                "name": "nop",
-                "program": [1002, 4, 3, 0, 99],
-                "inputs": [],
-                "outputs": []
-             },
-             {
-                 "name": "print input",
-                 "program": [3, 0, 4, 0, 99],
-                 "inputs": [123],
-                 "outputs": [123]
-             },
-             {
-                 "name": "is non-zero (position mode)",
-                 "program": [3,12,6,12,15,1,13,14,13,4,13,99,-1,0,1,9],
-                 "inputs": [123],
-                 "outputs": [1]
-             },
-             {
-                 "name": "is non-zero (position mode, negated)",
-                 "program": [3,12,6,12,15,1,13,14,13,4,13,99,-1,0,1,9],
-                 "inputs": [0],
-                 "outputs": [0]
-             },
-             {
-                 "name": "is non-zero (immediate mode)",
-                 "program": [3,3,1105,-1,9,1101,0,0,12,4,12,99,1],
-                 "inputs": [123],
-                 "outputs": [1]
-             },
-             {
-                 "name": "is non-zero (immediate mode, negated)",
-                 "program": [3,3,1105,-1,9,1101,0,0,12,4,12,99,1],
-                 "inputs": [0],
-                 "outputs": [0]
-             },
-             {
-                 "name": "day 5 larger example (less than 8)",
-                 "program": [3,21,1008,21,8,20,1005,20,22,107,8,21,20,1006,20,31,1106,0,36,98,0,0,1002,21,125,20,4,20,1105,1,46,104,999,1105,1,46,1101,1000,1,20,4,20,1105,1,46,98,99],
-                 "inputs": [4],
-                 "outputs": [999]
-             },
-             {
-                 "name": "day 5 larger example (equal 8)",
-                 "program": [3,21,1008,21,8,20,1005,20,22,107,8,21,20,1006,20,31,1106,0,36,98,0,0,1002,21,125,20,4,20,1105,1,46,104,999,1105,1,46,1101,1000,1,20,4,20,1105,1,46,98,99],
-                 "inputs": [8],
-                 "outputs": [1000]
-             },
-             {
-                 "name": "day 5 larger example (greater than 8)",
-                 "program": [3,21,1008,21,8,20,1005,20,22,107,8,21,20,1006,20,31,1106,0,36,98,0,0,1002,21,125,20,4,20,1105,1,46,104,999,1105,1,46,1101,1000,1,20,4,20,1105,1,46,98,99],
-                 "inputs": [10],
-                 "outputs": [1001]
-             },
-             {
-                 "name": "day 9 (quine)",
-                 "program": [109,1,204,-1,1001,100,1,100,1008,100,16,101,1006,101,0,99],
-                 "inputs": [],
-                 "outputs": [109,1,204,-1,1001,100,1,100,1008,100,16,101,1006,101,0,99]
-             },
-             {
-                 "name": "day 9 (16-digit number)",
-                 "program": [1102,34915192,34915192,7,4,7,99,0],
-                 "inputs": [],
-                 "outputs": 'special-16-digit'
-             },
-             {
-                 "name": "day 9 (large number)",
-                 "program": [104,1125899906842624,99],
-                 "inputs": [],
-                 "outputs": [1125899906842624]
-             }
+                "name": "compare and branch",
+                "program": [1101,0,0,30,1001,30,1,30,1007,30,10,31,1005,31,4,4,30,99],
+                "outputs": [10],
+                "fused": [0, 8]
+            },
+            {
+                "name": "compare and branch (relative)",
+                "program": [109,40,21101,0,0,0,21201,0,1,0,21207,0,10,1,1205,1,6,204,0,99],
+                "outputs": [10],
+                "fused": [2, 10]
+            },
+            {
+                "name": "first half writes into second",
+                "program": [1101,1,1,5,1101,0,0,20,4,20,99],
+                "outputs": [2],
+                "fused": []
+            },
+            {
+                "name": "first half writes into second (relative)",
+                "program": [109,7,21101,0,1,0,1101,0,0,30,4,30,99] + [0] * 20,
+                "outputs": [1],
+                "fused": []
+            },
+            {
+                "name": "second half grows memory",
+                "program": [1101,1,2,20,1101,3,4,5000,4,20,4,5000,99],
+                "outputs": [3, 7],
+                "fused": [0]
+            },
+            {
+                "name": "second half overflows compact memory",
+                "program": [1101,1,2,20,1102,3037000500,3037000500,21,4,20,4,21,99],
+                "outputs": [3, 9223372037000250000],
+                "fused": [0]
+            }
         ]
 
     overall_success = True
 
     for test in tests:
-        print ("Testing \"", test["name"], "\", ", test["inputs"], " -> ", test["outputs"], sep="")
+        for compact in (False, True):
+            print ("Testing fusion \"", test["name"], "\"", " (compact)" if compact else "", sep="")
 
-        machine = IntcodeMachine(verbose = False, debugging = "debugging" in test)
-        machine.set_program(test['program'])
-        machine.set_inputs(test['inputs'])
-
-        try:
+            machine = IntcodeMachine(engine = "threaded", compact = compact)
+            machine.set_program(test["program"])
             machine.run()
-        except IntcodeError as error:
-            print ("Fail: got IntcodeError", error)
+
+            reference = IntcodeMachine(engine = "step", compact = compact)
+            reference.set_program(test["program"])
+            reference.run()
+
+            memory = [machine.get_memory_value(x) for x in range(6000)]
+            expected = [reference.get_memory_value(x) for x in range(6000)]
+            fused = sorted(address for address, instruction in machine.threaded_code.items() if FUSED < instruction[0] < LATCH)
+            success = machine.get_outputs() == reference.get_outputs() == test["outputs"]
+            success = success and memory == expected and machine.step_counter == reference.step_counter
+
+            if success and fused == test["fused"]:
+                print ("Pass")
+            else:
+                print ("Fail: got", machine.get_outputs(), fused)
+                overall_success = False
+
+    print ("--")
+
+    return overall_success
+
+
+def testFastForward():
+    """Check skipping counted loops ends in the same state as running them."""
+
+    tests = [
+            {
+                "name": "count down",
+                "program": [1101,0,"bound",20,1001,20,-1,20,1005,20,4,4,20,99]
+            },
+            {
+                "name": "count up by three, with a total",
+                "program": [1101,0,0,30,1001,30,3,30,1001,31,7,31,1007,30,"bound",32,1005,32,4,4,30,4,31,4,32,99]
+            },
+            {
+                "name": "until equal (relative)",
+                "program": [109,40,21101,0,0,0,21201,0,2,0,21101,5,0,2,22101,0,2,3,21208,0,"bound",1,1206,1,6,204,0,204,2,204,3,99]
+            },
+            {
+                "name": "never finishes",
+                "program": [1001,20,1,20,1007,20,0,21,1006,21,0,99]
+            },
+            {
+                "name": "not a counted loop",
+                "program": [1101,1,0,20,102,2,20,20,1007,20,"bound",21,1005,21,4,4,20,99]
+            }
+        ]
+
+    overall_success = True
+
+    for test in tests:
+        print ("Testing fast-forward \"", test["name"], "\"", sep="")
+
+        # Small loops can be checked against running every instruction.
+        program = [1000 if word == "bound" else word for word in test["program"]]
+
+        machine = IntcodeMachine(engine = "threaded")
+        machine.set_program(program)
+        statuses = [machine.run_until(HALTED, budget = 2500), machine.run_until(HALTED, budget = 5000)]
+
+        reference = IntcodeMachine(engine = "step")
+        reference.set_program(program)
+        expected = [reference.run_until(HALTED, budget = 2500), reference.run_until(HALTED, budget = 5000)]
+
+        memory = [machine.get_memory_value(x) for x in range(50)]
+        expected_memory = [reference.get_memory_value(x) for x in range(50)]
+        success = statuses == expected and memory == expected_memory
+        success = success and machine.get_outputs() == reference.get_outputs() and machine.step_counter == reference.step_counter
+
+        if success:
+            print ("Pass")
+        else:
+            print ("Fail: got", statuses, machine.get_outputs(), machine.step_counter, "expected", expected, reference.get_outputs(), reference.step_counter)
+            overall_success = False
+
+    print ("Testing fast-forward over a billion iterations")
+
+    program = [1101,0,1000000000,20,1001,20,-1,20,1005,20,4,4,20,99]
+
+    machine = IntcodeMachine(engine = "threaded")
+    machine.set_program(program)
+    machine.run()
+
+    if machine.get_outputs() == [0] and machine.step_counter == 2000000003:
+        print ("Pass")
+    else:
+        print ("Fail: got", machine.get_outputs(), machine.step_counter)
+        overall_success = False
+
+    print ("--")
+
+    return overall_success
+
+
+def testHooks():
+    """Add and remove hooks between runs, and check what they see."""
+
+    # Echo each input until a zero arrives.
+    program = [3,100,4,100,1005,100,0,99]
+
+    overall_success = True
+
+    for engine in ENGINES:
+        print ("Testing hooks (", engine, ")", sep="")
+
+        machine = IntcodeMachine(engine = engine)
+        machine.set_program(program)
+        machine.add_inputs([1, 2, 3, 0])
+
+        seen = []
+        outputs = []
+        hook = lambda record: seen.append(record[0])
+        output_hook = lambda record: outputs.append(record[6]) if record[1] == 4 else None
+
+        statuses = [machine.run_until(OUTPUT)]
+        machine.add_hook(hook)
+        machine.add_hook(output_hook)
+        statuses.append(machine.run_until(OUTPUT))
+        machine.remove_hook(hook)
+        statuses.append(machine.run_until(OUTPUT))
+        machine.remove_hook(output_hook)
+        statuses.append(machine.run_until(HALTED))
+
+        success = statuses == [OUTPUT, OUTPUT, OUTPUT, HALTED] and machine.get_outputs() == [1, 2, 3, 0]
+
+        if success and seen == [4, 0, 2] and outputs == [2, 3] and not machine.hooks:
+            print ("Pass")
+        else:
+            print ("Fail: got", statuses, seen, outputs)
+            overall_success = False
+
+    print ("--")
+
+    return overall_success
+
+
+def testSnapshots():
+    """Fork machines from a checkpoint and make sure they don't interfere."""
+
+    # Keep running totals of the inputs in a low and a high memory address,
+    # outputting the low one each time.
+    program = [3,50,1,50,51,51,1,50,1000000,1000000,4,51,1105,1,0] + [0] * 40
+
+    overall_success = True
+
+    for engine, compact in product(ENGINES, (False, True)):
+        print ("Testing snapshots (", engine, ", compact" if compact else "", ")", sep="")
+
+        parent = IntcodeMachine(engine = engine, compact = compact)
+        parent.set_program(program)
+        parent.add_input(5)
+        parent.run_until(INPUT)
+
+        snapshot = parent.snapshot()
+        children = [parent.fork(), parent.fork(snapshot), parent.fork(snapshot)]
+        machines = children + [parent]
+
+        for machine, value in zip(machines, [1, 10, 0, 100]):
+            machine.add_input(value)
+            machine.run_until(INPUT)
+
+        results = [(machine.get_outputs(), machine.get_memory_value(1000000)) for machine in machines]
+        expected = [([5, 6], 6), ([5, 15], 15), ([5, 5], 5), ([5, 105], 105)]
+
+        if results == expected and parent.fork(snapshot).get_memory_value(1000000) == 5:
+            print ("Pass")
+        else:
+            print ("Fail: got", results)
+            overall_success = False
+
+    print ("--")
+
+    return overall_success
+
+
+def testCheckpoints():
+    """Checkpoint machines to files, restore them and carry on."""
+
+    # Keep running totals of the inputs in a low and a high memory address,
+    # outputting the low one each time.
+    program = [3,50,1,50,51,51,1,50,1000000,1000000,4,51,1105,1,0] + [0] * 40
+
+    overall_success = True
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "machine.checkpoint")
+
+        for engine, compact in product(ENGINES, (False, True)):
+            print ("Testing checkpoints (", engine, ", compact" if compact else "", ")", sep="")
+
+            machine = IntcodeMachine(engine = engine, compact = compact)
+            machine.set_program(program)
+            machine.add_inputs([5, 6])
+            machine.run_until(INPUT)
+
+            if os.path.exists(path):
+                os.remove(path)
+
+            # The first checkpoint writes the dense page and the sparse one.
+            # After that, only pages which have changed are written.
+            written = [machine.checkpoint(path)]
+            machine.add_input(7)
+            machine.run_until(INPUT)
+            machine.add_input(100)
+            written.append(machine.checkpoint(path))
+            written.append(machine.checkpoint(path))
+            machine.set_memory_value(60, 9)
+            written.append(machine.checkpoint(path))
+
+            restored = IntcodeMachine.restore(path, engine = engine)
+            results = []
+
+            for each in (machine, restored):
+                each.add_input(1)
+                each.run_until(INPUT)
+                results.append((each.get_outputs(), each.get_memory_value(1000000), each.get_memory_value(60), each.step_counter, each.ip))
+
+            # A new page is written along with the two the last run changed.
+            machine.set_memory_value(5000000, 1)
+            written.append(machine.checkpoint(path))
+            grown = IntcodeMachine.restore(path)
+
+            success = results[0] == results[1] and results[0][:3] == ([5, 11, 18, 118, 119], 119, 9)
+            success = success and written == [2, 2, 0, 1, 3] and grown.get_memory_value(5000000) == 1
+
+            if success:
+                print ("Pass")
+            else:
+                print ("Fail: got", results, written)
+                overall_success = False
+
+        print ("Testing a checkpoint which isn't committed")
+
+        machine = IntcodeMachine()
+        machine.set_program(program)
+        machine.add_inputs([5, 6])
+        machine.run_until(INPUT)
+        machine.checkpoint(path)
+        machine.add_input(7)
+        machine.run_until(INPUT)
+        machine.checkpoint(path)
+
+        # Tear the slot the second checkpoint was committed in, as if the
+        # machine had crashed while writing it.
+        with open(path, "r+b") as f:
+            f.seek(2 % 2 * CHECKPOINT_SLOT.size + 12)
+            f.write(b"torn")
+
+        restored = IntcodeMachine.restore(path)
+
+        # The file no longer holds the machine's last checkpoint, so it's
+        # written again in full.
+        written = machine.checkpoint(path)
+        recovered = IntcodeMachine.restore(path)
+
+        if restored.get_outputs() == [5, 11] and written == 2 and recovered.get_outputs() == [5, 11, 18]:
+            print ("Pass")
+        else:
+            print ("Fail: got", restored.get_outputs(), written, recovered.get_outputs())
             overall_success = False
-            print ("--")
-            continue
 
-        result = machine.get_outputs()
+        print ("Testing checkpoints being compacted")
 
-        special = False
+        written = []
 
-        if test['outputs'] == 'special-16-digit' and len(str(result[0])) == 16:
-            special = True
+        for value in range(20):
+            machine.set_memory_value(60, value)
+            written.append(machine.checkpoint(path))
 
-        if result == test["outputs"] or special:
+        if written.count(2) > 1 and os.path.getsize(path) < (CHECKPOINT_COMPACT_RATIO + 1) * 2 * PAGE_SIZE * 8:
             print ("Pass")
         else:
-            print ("Fail: got ", result)
+            print ("Fail: got", written, os.path.getsize(path))
+            overall_success = False
+
+        print ("Testing checkpoints with values too big to save")
+
+        machine = IntcodeMachine()
+        machine.set_program([104,1,99])
+        machine.add_input(2 ** 70)
+
+        try:
+            machine.checkpoint(path)
+            print ("Fail: no IntcodeError")
             overall_success = False
-            exit()
+        except IntcodeError:
+            print ("Pass")
 
+    print ("--")
+
+    return overall_success
+
+
+def testBatchIntcodeMachine():
+    """Check batches of machines against machines run one at a time."""
+
+    if numpy is None:
+        print ("Skipping batch tests: NumPy isn't installed")
         print ("--")
+        return True
+
+    day5 = [3,21,1008,21,8,20,1005,20,22,107,8,21,20,1006,20,31,1106,0,36,98,0,0,1002,21,125,20,4,20,1105,1,46,104,999,1105,1,46,1101,1000,1,20,4,20,1105,1,46,98,99]
+    quine = [109,1,204,-1,1001,100,1,100,1008,100,16,101,1006,101,0,99]
+
+    with open("aoc-9.1.input") as f:
+        boost = [int(i) for i in f.readlines()[0].split(",")]
+
+    tests = [
+            {
+                "name": "day 5 larger example",
+                "program": day5,
+                "inputs": [[4], [8], [10], [7], []]
+            },
+            {
+                "name": "day 9 (quine)",
+                "program": quine,
+                "inputs": [[], []]
+            },
+            {
+                "name": "self-modifying (operand)",
+                "program": [104,7,1001,1,1,1,1008,1,9,30,1006,30,0,99],
+                "inputs": [[], []]
+            },
+            {
+                "name": "day 9 BOOST (test mode)",
+                "program": boost,
+                "inputs": [[1], [1], []]
+            }
+        ]
+
+    overall_success = True
+
+    for test in tests:
+        print ("Testing batch \"", test["name"], "\" x ", len(test["inputs"]), sep="")
+
+        expected = []
+
+        for inputs in test["inputs"]:
+            machine = IntcodeMachine()
+            machine.set_program(test["program"])
+            machine.set_inputs(inputs)
+            machine.run_until(HALTED)
+            expected.append(machine.get_outputs())
+
+        batch = BatchIntcodeMachine(test["program"], len(test["inputs"]), test["inputs"])
+        result = batch.run()
+
+        if result == expected:
+            print ("Pass")
+        else:
+            print ("Fail: got", result)
+            overall_success = False
+
+    print ("Testing batch with a high memory address")
+
+    batch = BatchIntcodeMachine([1101,1,2,3000000,99], 4)
+
+    try:
+        batch.run()
+        print ("Fail: no IntcodeError")
+        overall_success = False
+    except IntcodeError:
+        print ("Pass")
 
+    print ("--")
 
     return overall_success
 
@@ -556,9 +3394,65 @@ def main():
         print("IntcodeMachine tests failed.")
         exit()
 
+    if not testRunUntil():
+        print("run_until tests failed.")
+        exit()
+
+    if not testNegativeAddresses():
+        print("Negative address tests failed.")
+        exit()
+
+    if not testQueues():
+        print("Queue tests failed.")
+        exit()
+
+    if not testExecute():
+        print("execute tests failed.")
+        exit()
+
+    if not testProfiler():
+        print("Profiler tests failed.")
+        exit()
+
+    if not testTracing():
+        print("Tracing tests failed.")
+        exit()
+
+    if not testInvalidation():
+        print("Invalidation tests failed.")
+        exit()
+
+    if not testDeoptimisation():
+        print("Deoptimisation tests failed.")
+        exit()
+
+    if not testFusion():
+        print("Fusion tests failed.")
+        exit()
+
+    if not testFastForward():
+        print("Fast-forward tests failed.")
+        exit()
+
+    if not testHooks():
+        print("Hook tests failed.")
+        exit()
+
+    if not testSnapshots():
+        print("Snapshot tests failed.")
+        exit()
+
+    if not testCheckpoints():
+        print("Checkpoint tests failed.")
+        exit()
+
+    if not testBatchIntcodeMachine():
+        print("Batch tests failed.")
+        exit()
+
     print ("Tests passed.")
 
-    machine = IntcodeMachine(debugging = False)
+    machine = IntcodeMachine(debugging = False, engine = "threaded")
     machine.load_program_from_file("aoc-9.1.input")
     machine.add_input(2)
     machine.run()
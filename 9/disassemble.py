@@ -0,0 +1,496 @@
+#!/usr/bin/env python
+
+"""
+Static analysis of Intcode programs.
+
+Decodes every instruction reachable from address 0, following jumps whose
+targets are immediate values, and splits them into basic blocks joined by
+a control-flow graph. Loops, data regions and writes into code are marked
+up. The results are printed as a listing, or written next to the program
+as a DOT graph or as JSON.
+
+Usage: disassemble.py [filename] [--dot] [--json]
+"""
+
+import sys
+import json
+
+
+# Parameter modes.
+POSITIONAL = 0
+IMMEDIATE = 1
+RELATIVE = 2
+
+
+# Number of memory cells (opcode plus parameters) used by each instruction.
+INSTRUCTION_LENGTHS = {
+    1: 4,
+    2: 4,
+    3: 2,
+    4: 2,
+    5: 3,
+    6: 3,
+    7: 4,
+    8: 4,
+    9: 2,
+    99: 1
+}
+
+
+# Names of each instruction, for listings.
+OPCODE_NAMES = {
+    1: "add",
+    2: "multiply",
+    3: "input",
+    4: "output",
+    5: "jump if true",
+    6: "jump if false",
+    7: "less than",
+    8: "equals",
+    9: "relative base offset",
+    99: "halt"
+}
+
+
+# Which parameter each instruction writes to, if any.
+WRITE_PARAMETERS = {
+    1: 2,
+    2: 2,
+    3: 0,
+    7: 2,
+    8: 2
+}
+
+
+def read_program(filename):
+    """Read a single line of comma-separated integers into an array."""
+
+    with open(filename) as f:
+        first_line = f.readlines()[0].split(",")
+
+        return [int(i) for i in first_line]
+
+
+def decode(program, address):
+    """
+    Decode the instruction at an address.
+
+    Returns a tuple of (opcode, modes, operands), or None if there isn't a
+    legal instruction there.
+    """
+
+    if not 0 <= address < len(program):
+        return None
+
+    word = program[address]
+    opcode = word % 100
+
+    if word < 0 or not opcode in INSTRUCTION_LENGTHS:
+        return None
+
+    length = INSTRUCTION_LENGTHS[opcode]
+    modes = (word // 100 % 10, word // 1000 % 10, word // 10000 % 10)
+
+    if word >= 100000 or any(mode > RELATIVE for mode in modes):
+        return None
+
+    # Modes for parameters the instruction doesn't have must be zero.
+    if any(modes[length - 1:]):
+        return None
+
+    if opcode in WRITE_PARAMETERS and modes[WRITE_PARAMETERS[opcode]] == IMMEDIATE:
+        return None
+
+    if address + length > len(program):
+        return None
+
+    return opcode, modes[:length - 1], program[address + 1:address + length]
+
+
+def successors(address, instruction):
+    """
+    Work out where control can go after an instruction.
+
+    Returns the list of known next addresses, and whether the instruction can
+    also jump somewhere which can't be known without running the program.
+    """
+
+    opcode, modes, operands = instruction
+
+    if opcode == 99:
+        return [], False
+
+    if not opcode in (5, 6):
+        return [address + INSTRUCTION_LENGTHS[opcode]], False
+
+    following = address + 3
+    condition_known = modes[0] == IMMEDIATE
+    always_jumps = condition_known and (operands[0] != 0) == (opcode == 5)
+    never_jumps = condition_known and not always_jumps
+    targets = [] if always_jumps else [following]
+
+    if never_jumps:
+        return targets, False
+
+    if modes[1] == IMMEDIATE:
+        return [operands[1]] + targets, False
+
+    return targets, True
+
+
+class ProgramAnalysis:
+    """The instructions, blocks and loops of an Intcode program."""
+
+    def __init__(self, program):
+        self.program = program
+        self.instructions = {}
+        self.edges = {}
+        self.indirect_jumps = set()
+        self.code_cells = set()
+        self.blocks = {}
+        self.block_edges = {}
+        self.loops = []
+        self.self_modifying_writes = []
+        self.data_regions = []
+
+        self.find_instructions()
+        self.find_blocks()
+        self.find_loops()
+        self.find_self_modifying_writes()
+        self.find_data_regions()
+
+
+    def find_instructions(self):
+        """Decode everything reachable from address 0."""
+
+        pending = [0]
+
+        while pending:
+            address = pending.pop()
+
+            if address in self.instructions:
+                continue
+
+            instruction = decode(self.program, address)
+
+            if instruction is None:
+                continue
+
+            self.instructions[address] = instruction
+            self.code_cells.update(range(address, address + INSTRUCTION_LENGTHS[instruction[0]]))
+
+            targets, indirect = successors(address, instruction)
+            self.edges[address] = targets
+
+            if indirect:
+                self.indirect_jumps.add(address)
+
+            pending.extend(targets)
+
+
+    def find_blocks(self):
+        """Split the instructions into basic blocks, keyed by first address."""
+
+        leaders = {0}
+
+        for address, targets in self.edges.items():
+            opcode = self.instructions[address][0]
+
+            if opcode in (5, 6, 99):
+                leaders.update(targets)
+                leaders.add(address + INSTRUCTION_LENGTHS[opcode])
+
+        for leader in sorted(leaders):
+            if not leader in self.instructions:
+                continue
+
+            block = [leader]
+            address = leader
+
+            while True:
+                opcode = self.instructions[address][0]
+
+                if opcode in (5, 6, 99):
+                    break
+
+                following = address + INSTRUCTION_LENGTHS[opcode]
+
+                if following in leaders or not following in self.instructions:
+                    break
+
+                address = following
+                block.append(address)
+
+            self.blocks[leader] = block
+            self.block_edges[leader] = [target for target in self.edges[block[-1]] if target in self.instructions]
+
+
+    def find_loops(self):
+        """
+        Find loops by looking for edges back to a block which is still being
+        explored, depth first from the entry. Each loop is a (header, latch)
+        pair of block addresses.
+        """
+
+        if not 0 in self.blocks:
+            return
+
+        visited = {0}
+        on_stack = {0}
+        stack = [(0, iter(self.block_edges[0]))]
+
+        while stack:
+            block, targets = stack[-1]
+            target = next(targets, None)
+
+            if target is None:
+                stack.pop()
+                on_stack.discard(block)
+                continue
+
+            if target in on_stack:
+                self.loops.append((target, block))
+            elif not target in visited:
+                visited.add(target)
+                on_stack.add(target)
+                stack.append((target, iter(self.block_edges[target])))
+
+        self.loops.sort()
+
+
+    def find_self_modifying_writes(self):
+        """
+        Find instructions which write to a fixed address inside the code.
+
+        Writes in relative mode depend on the relative base at the time, so
+        they can't be checked here.
+        """
+
+        for address, (opcode, modes, operands) in sorted(self.instructions.items()):
+            if not opcode in WRITE_PARAMETERS:
+                continue
+
+            parameter = WRITE_PARAMETERS[opcode]
+
+            if modes[parameter] == POSITIONAL and operands[parameter] in self.code_cells:
+                self.self_modifying_writes.append((address, operands[parameter]))
+
+
+    def find_data_regions(self):
+        """Find the runs of cells in the program image which aren't code."""
+
+        start = None
+
+        for address in range(len(self.program) + 1):
+            is_data = address < len(self.program) and not address in self.code_cells
+
+            if is_data and start is None:
+                start = address
+            elif not is_data and start is not None:
+                self.data_regions.append((start, address - 1))
+                start = None
+
+
+    def format_instruction(self, address):
+        """Describe one instruction in a line of text."""
+
+        opcode, modes, operands = self.instructions[address]
+        parameters = []
+
+        for mode, operand in zip(modes, operands):
+            if mode == POSITIONAL:
+                parameters.append("[{operand}]".format(operand=operand))
+            elif mode == RELATIVE:
+                parameters.append("[rb{operand:+}]".format(operand=operand))
+            else:
+                parameters.append(str(operand))
+
+        return "{name} {parameters}".format(name=OPCODE_NAMES[opcode], parameters=", ".join(parameters)).strip()
+
+
+    def listing(self):
+        """Make a listing of the whole program, with blocks and data marked."""
+
+        loop_headers = {header for header, latch in self.loops}
+        modified = {address for address, dest in self.self_modifying_writes}
+        data_starts = {start: end for start, end in self.data_regions}
+        lines = []
+        address = 0
+
+        while address < len(self.program):
+            if address in data_starts:
+                end = data_starts[address]
+                lines.append("{address:>6}: data {values}".format(address=address, values=self.program[address:end + 1]))
+                address = end + 1
+                continue
+
+            if not address in self.instructions:
+                # Part of an instruction which overlaps another one.
+                address += 1
+                continue
+
+            if address in self.blocks:
+                notes = []
+
+                if address in loop_headers:
+                    notes.append("loop header")
+
+                lines.append("")
+                lines.append("block {address}:{notes}".format(address=address, notes=" (" + ", ".join(notes) + ")" if notes else ""))
+
+            line = "{address:>6}: {text}".format(address=address, text=self.format_instruction(address))
+
+            if address in modified:
+                line += "    ; writes into code"
+
+            if address in self.indirect_jumps:
+                line += "    ; indirect jump"
+
+            lines.append(line)
+            address += INSTRUCTION_LENGTHS[self.instructions[address][0]]
+
+        return "\n".join(lines).strip("\n")
+
+
+    def to_dot(self):
+        """Describe the control-flow graph in Graphviz's DOT language."""
+
+        back_edges = set(self.loops)
+        lines = ["digraph intcode {", "  node [shape=box fontname=monospace];"]
+
+        for leader, block in sorted(self.blocks.items()):
+            label = "\\l".join("{address}: {text}".format(address=address, text=self.format_instruction(address)) for address in block)
+            lines.append("  b{leader} [label=\"{label}\\l\"];".format(leader=leader, label=label))
+
+        for leader, targets in sorted(self.block_edges.items()):
+            for target in targets:
+                style = " [style=dashed]" if (target, leader) in back_edges else ""
+                lines.append("  b{leader} -> b{target}{style};".format(leader=leader, target=target, style=style))
+
+        lines.append("}")
+
+        return "\n".join(lines)
+
+
+    def to_json(self):
+        """Describe the blocks, edges, loops and data regions as JSON."""
+
+        return json.dumps({
+            "blocks": [
+                {
+                    "start": leader,
+                    "instructions": [[address, self.format_instruction(address)] for address in block],
+                    "successors": self.block_edges[leader],
+                    "indirect": block[-1] in self.indirect_jumps
+                }
+                for leader, block in sorted(self.blocks.items())
+            ],
+            "loops": [{"header": header, "latch": latch} for header, latch in self.loops],
+            "self_modifying_writes": [{"instruction": address, "destination": dest} for address, dest in self.self_modifying_writes],
+            "data_regions": [[start, end] for start, end in self.data_regions]
+        }, indent = 2)
+
+
+def testAnalysis():
+    """Analyse some small programs and check what's found."""
+
+    tests = [
+            {
+                "name": "straight line",
+                "program": [3,0,4,0,99],
+                "blocks": {0: [0, 2, 4]},
+                "loops": [],
+                "writes": [(0, 0)],
+                "data": []
+            },
+            {
+                "name": "echo loop",
+                "program": [3,100,4,100,1005,100,0,99],
+                "blocks": {0: [0, 2, 4], 7: [7]},
+                "loops": [(0, 0)],
+                "writes": [],
+                "data": []
+            },
+            {
+                "name": "countdown with data",
+                "program": [1101,5,0,16,4,16,1001,16,-1,16,1005,16,4,99,42,42,0],
+                "blocks": {0: [0], 4: [4, 6, 10], 13: [13]},
+                "loops": [(4, 4)],
+                "writes": [],
+                "data": [(14, 16)]
+            },
+            {
+                "name": "unconditional jump over data",
+                "program": [1105,1,5,7,7,2105,1,0,99],
+                "blocks": {0: [0], 5: [5]},
+                "loops": [],
+                "writes": [],
+                "data": [(3, 4), (8, 8)]
+            },
+            {
+                "name": "output with a stray mode",
+                "program": [1104,5,99],
+                "blocks": {},
+                "loops": [],
+                "writes": [],
+                "data": [(0, 2)]
+            },
+            {
+                "name": "halt with a stray mode",
+                "program": [104,5,199],
+                "blocks": {0: [0]},
+                "loops": [],
+                "writes": [],
+                "data": [(2, 2)]
+            },
+            {
+                "name": "self-modifying (operand)",
+                "program": [104,7,1001,1,1,1,1008,1,9,30,1006,30,0,99],
+                "blocks": {0: [0, 2, 6, 10], 13: [13]},
+                "loops": [(0, 0)],
+                "writes": [(2, 1)],
+                "data": []
+            }
+        ]
+
+    overall_success = True
+
+    for test in tests:
+        print ("Testing analysis of \"", test["name"], "\"", sep="")
+
+        analysis = ProgramAnalysis(test["program"])
+        found = (analysis.blocks, analysis.loops, analysis.self_modifying_writes, analysis.data_regions)
+        expected = (test["blocks"], test["loops"], test["writes"], test["data"])
+
+        if found == expected and json.loads(analysis.to_json()) and analysis.to_dot().startswith("digraph"):
+            print ("Pass")
+        else:
+            print ("Fail: got", found)
+            overall_success = False
+
+    print ("--")
+
+    return overall_success
+
+
+def main():
+    if not testAnalysis():
+        print("Analysis tests failed.")
+        exit()
+
+    arguments = [argument for argument in sys.argv[1:] if not argument.startswith("--")]
+    filename = arguments[0] if arguments else "aoc-9.1.input"
+    analysis = ProgramAnalysis(read_program(filename))
+
+    print (analysis.listing())
+
+    for option, extension, describe in (("--dot", ".dot", analysis.to_dot), ("--json", ".json", analysis.to_json)):
+        if option in sys.argv:
+            with open(filename + extension, "w") as f:
+                f.write(describe() + "\n")
+
+            print ("Wrote", filename + extension)
+
+
+if __name__ == "__main__":
+    main()